@@ -0,0 +1,109 @@
+#!/usr/bin/env python2
+"""
+compares util.try_decode (one exception per failed codec) with
+LineDecoder.LineDecoder, which remembers the codec of nicks whose lines
+aren't in the preferred codec, and with a variant of try_decode that
+checks for pure ASCII with a regex first.
+
+LineDecoder gets the nick of a line from IRCConnection.nickOf, as in
+IRCConnection, so the time includes the nick extraction where it is
+needed.
+
+the traffic is a mix of IRC lines from 50 nicks: most write plain ASCII,
+some UTF-8, and some use legacy clients that send latin-1.
+
+usage: python2 bench/irc_decode.py
+"""
+import os
+import sys
+import random
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "sftbot"))
+import re
+import util
+import LineDecoder
+import IRCConnection
+
+nonascii = re.compile(b'[\\x80-\\xff]')
+
+
+def asciiCheckTryDecode(line, preferredcodec):
+    if nonascii.search(line) is None:
+        return line.decode('ascii')
+    return util.try_decode(line, preferredcodec)
+
+
+def makeTraffic(count, asciishare, latin1share):
+    """
+    returns a list of (nick, line) tuples.
+    """
+    rand = random.Random(42)
+    nicks = []
+    for i in range(50):
+        r = rand.random()
+        if r < latin1share:
+            nicks.append(("legacy%d" % i, 'latin-1'))
+        elif r < latin1share + (1 - asciishare - latin1share):
+            nicks.append(("user%d" % i, 'utf-8'))
+        else:
+            nicks.append(("plain%d" % i, 'ascii'))
+
+    texts = {
+        'ascii': u"hey, did anybody see the match yesterday?",
+        'utf-8': u"gr\xfc\xdfe aus m\xfcnchen, sch\xf6nes wetter heute",
+        'latin-1': u"gr\xfc\xdfe aus m\xfcnchen, sch\xf6nes wetter heute",
+    }
+    traffic = []
+    for _ in range(count):
+        nick, encoding = rand.choice(nicks)
+        text = texts[encoding]
+        line = ":%s!%s@example.org PRIVMSG #chan :" % (nick, nick)
+        traffic.append((nick, line + text.encode(encoding)))
+    return traffic
+
+
+def main():
+    mixes = [
+        ("all ascii", 1.0, 0.0),
+        ("80% ascii, 10% utf-8, 10% latin-1", 0.8, 0.1),
+        ("40% ascii, 30% utf-8, 30% latin-1", 0.4, 0.3),
+    ]
+    number = 20
+
+    for name, asciishare, latin1share in mixes:
+        traffic = makeTraffic(5000, asciishare, latin1share)
+
+        def old():
+            for nick, line in traffic:
+                util.try_decode(line, 'utf-8')
+
+        def asciiCheck():
+            for nick, line in traffic:
+                asciiCheckTryDecode(line, 'utf-8')
+
+        decoder = LineDecoder.LineDecoder(
+            'utf-8', sourceof=IRCConnection.nickOf)
+
+        def cached():
+            for nick, line in traffic:
+                decoder.decode(line)
+
+        oldTime = min(timeit.repeat(old, number=number, repeat=5))
+        asciiCheckTime = min(timeit.repeat(asciiCheck, number=number,
+                                            repeat=5))
+        cachedTime = min(timeit.repeat(cached, number=number, repeat=5))
+        lines = float(len(traffic) * number)
+
+        print(name)
+        print("  try_decode:             %6.3f us/line" %
+              (oldTime / lines * 1e6))
+        print("  ASCII check+try_decode: %6.3f us/line" %
+              (asciiCheckTime / lines * 1e6))
+        print("  LineDecoder:            %6.3f us/line" %
+              (cachedTime / lines * 1e6))
+        print("  %r" % decoder.stats())
+
+
+if __name__ == "__main__":
+    main()
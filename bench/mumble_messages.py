@@ -0,0 +1,126 @@
+#!/usr/bin/env python2
+"""
+compares two ways of handling mumble messages:
+
+- clearing pool: one instance per type for received and sent messages,
+  cleared before every use (the first MessagePool)
+- new objects: a new pb2 object for every received frame, every ping and
+  every sent text message, as MumbleConnection does
+
+one relayed message is: a received TextMessage, which is parsed, and a
+TextMessage that is sent in reply, plus one ping.
+
+reports the time per relayed message, and the objects allocated per
+relayed message, counted with gc: every object that a relay creates is
+kept alive, and the number of new gc-tracked objects (pb2 messages are
+gc-tracked) is divided by the number of relays.
+
+usage: python2 bench/mumble_messages.py
+"""
+import gc
+import os
+import sys
+import timeit
+
+root = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, root)
+sys.path.insert(0, os.path.join(root, "sftbot"))
+import MumbleFraming
+import MumbleConnection
+import sftbot.protobuf.Mumble_pb2 as pb2
+
+
+class ClearingPool(object):
+    """
+    the MessagePool as it was first implemented.
+    """
+
+    def __init__(self):
+        self._instances = {}
+
+    def get(self, messagetype):
+        pbMess = self._instances.get(messagetype)
+        if pbMess is None:
+            pbMess = messagetype()
+            self._instances[messagetype] = pbMess
+        else:
+            pbMess.Clear()
+        return pbMess
+
+
+def makeFrame(text):
+    pbMess = pb2.TextMessage()
+    pbMess.actor = 42
+    pbMess.channel_id.append(1)
+    pbMess.message = text
+    return memoryview(pbMess.SerializeToString())
+
+
+def sendReply(writer, reply, ping, text):
+    reply.session.append(1)
+    reply.channel_id.append(1)
+    reply.message = text
+    writer.appendFrame(pb2.TextMessage.typeID, reply.SerializeToString())
+    ping.timestamp = 1234567890
+    writer.appendFrame(pb2.Ping.typeID, ping.SerializeToString())
+    writer._start = writer._end = 0
+
+
+def newObjects(writer, data):
+    pbMess = MumbleConnection.parseMessage(pb2.TextMessage, data)
+    reply = pb2.TextMessage()
+    ping = pb2.Ping()
+    sendReply(writer, reply, ping, pbMess.message)
+    return pbMess, reply, ping
+
+
+def clearingPool(writer, rxPool, txPool, data):
+    pbMess = rxPool.get(pb2.TextMessage)
+    pbMess.ParseFromString(data.tobytes())
+    reply = txPool.get(pb2.TextMessage)
+    ping = txPool.get(pb2.Ping)
+    sendReply(writer, reply, ping, pbMess.message)
+    return pbMess, reply, ping
+
+
+def allocationsPerCall(function, number):
+    """
+    returns the number of gc-tracked objects that function() creates per
+    call, keeping all of its results alive.
+    """
+    kept = []
+    gc.collect()
+    gc.disable()
+    try:
+        before = len(gc.get_objects())
+        for _ in range(number):
+            kept.append(function())
+        after = len(gc.get_objects())
+    finally:
+        gc.enable()
+    # the result tuples and the list itself are gc-tracked, too.
+    return max(0, after - before - number - 1) / float(number)
+
+
+def main():
+    data = makeFrame("hello from irc, " * 4)
+    number = 50000
+
+    writer = MumbleFraming.FrameWriter()
+    rxPool = ClearingPool()
+    txPool = ClearingPool()
+    variants = [
+        ("clearing pool", lambda: clearingPool(writer, rxPool, txPool,
+                                               data)),
+        ("new objects", lambda: newObjects(writer, data)),
+    ]
+
+    for name, function in variants:
+        seconds = min(timeit.repeat(function, number=number, repeat=15))
+        print("%-14s %6.2f us/message, %5.2f objects allocated/message" %
+              (name, seconds / number * 1e6,
+               allocationsPerCall(function, 1000)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python2
+"""
+compares the old mumble send path (one socket write per message, re-slicing
+the packed message after partial writes) with MumbleFraming.FrameWriter
+(one coalesced write per burst through a memoryview).
+
+the socket is simulated, and accepts at most 16 kB per send() call,
+like an SSL socket does.
+
+usage: python2 bench/mumble_send.py
+"""
+import os
+import sys
+import struct
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "sftbot"))
+import MumbleFraming
+
+
+class FakeSocket(object):
+    def __init__(self):
+        self.calls = 0
+        self.bytes = 0
+
+    def send(self, data):
+        self.calls += 1
+        sent = min(len(data), 16384)
+        self.bytes += sent
+        return sent
+
+
+class FakeMessage(object):
+    """
+    stands in for a pb2 message with a fixed serialization.
+    """
+    def __init__(self, typeID, size):
+        self.typeID = typeID
+        self._data = b"x" * size
+
+    def SerializeToString(self):
+        return self._data
+
+
+def oldSend(sock, message):
+    stringMessage = message.SerializeToString()
+    length = len(stringMessage)
+    header = struct.pack(">HI", message.typeID, length)
+    packedMessage = header + stringMessage
+    while len(packedMessage) > 0:
+        sent = sock.send(packedMessage)
+        if sent < 0:
+            raise Exception("could not send message")
+        packedMessage = packedMessage[sent:]
+
+
+def oldBurst(sock, burst):
+    for message in burst:
+        oldSend(sock, message)
+
+
+def newBurst(sock, writer, burst):
+    for message in burst:
+        writer.appendFrame(message.typeID, message.SerializeToString())
+    writer.writeTo(sock)
+
+
+def main():
+    bursts = {
+        "ping": [FakeMessage(3, 0)],
+        "10 text messages + ping": [FakeMessage(11, 120)] * 10 +
+                                   [FakeMessage(3, 0)],
+        "1 large text message (200 kB)": [FakeMessage(11, 200000)],
+    }
+    number = 20000
+
+    for name, burst in sorted(bursts.items()):
+        scale = 1 if len(burst[0].SerializeToString()) < 100000 else 100
+        n = number // scale
+
+        oldSock = FakeSocket()
+        oldTime = timeit.timeit(lambda: oldBurst(oldSock, burst), number=n)
+
+        newSock = FakeSocket()
+        writer = MumbleFraming.FrameWriter()
+        newTime = timeit.timeit(lambda: newBurst(newSock, writer, burst),
+                                number=n)
+
+        assert oldSock.bytes == newSock.bytes
+
+        print(name)
+        print("  old: %8.2f us/burst, %5.1f send() calls/burst" %
+              (oldTime / n * 1e6, float(oldSock.calls) / n))
+        print("  new: %8.2f us/burst, %5.1f send() calls/burst" %
+              (newTime / n * 1e6, float(newSock.calls) / n))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,30 @@
 import sys
+import time
 import socket
+import random
 import string
-import thread
-import threading
 import traceback
+import collections
 import util
+import EventLoop
+import TokenBucket
+import LatencyStats
+import LogWriter
+import Metrics
+
+# priority classes for _sendMessage().
+# urgent messages (e.g. PING replies) are sent before all others, and are
+# not delayed by the rate limit.
+PRIORITY_URGENT = 0
+PRIORITY_NORMAL = 1
+
+# (connection name, receive time) of the text message whose callbacks
+# are running; text messages sent from them are relayed messages.
+_relayOrigin = None
+
+# queued callbacks are run for at most this many seconds at once, before
+# the event loop gets the chance to read from the connections again.
+CALLBACK_SLICE = 0.05
 
 
 class AbstractConnection(object):
@@ -14,16 +34,157 @@ class AbstractConnection(object):
     MumbleConnection, IRCConnection and others inherit from this.
     """
 
-    def __init__(self, name, loglevel):
+    def __init__(self, name, loglevel, loop=None, sendqueuelimit=1000,
+                 sendrate=0, sendburst=1, establishtimeout=60,
+                 callbackqueuelimit=1000, callbackbudget=0.1,
+                 reconnect=False, reconnectdelay=5, reconnectmaxdelay=300,
+                 reconnectjitter=0.25, reconnectstable=60, holdlimit=100,
+                 holdtime=600,
+                 logwriter=None, metrics=None):
         """
         MUST NOT build an actual connection, just store config values.
 
         MAY be overloaded.
         Overloads MUST call this function as superconstructor.
+
+        sendqueuelimit is the maximum number of messages that may wait for
+        being sent; further messages are dropped.
+
+        if sendrate is not 0, at most sendrate messages per second are
+        sent on average, with bursts of up to sendburst messages.
+
+        if the connection isn't established within establishtimeout
+        seconds after the connection attempt started, it is closed.
+
+        the callbacks are not run while the received data is handled, but
+        queued and run from the event loop afterwards, in the order of the
+        events. at most callbackqueuelimit text messages may wait for their
+        callbacks; further ones are dropped. a warning is logged for every
+        callback that takes longer than callbackbudget seconds.
+
+        if reconnect is True, the connection is reconnected whenever it is
+        lost or can't be opened, until stop() is called: right away after
+        a clean disconnect, and otherwise after reconnectdelay seconds,
+        doubled after each failed attempt up to reconnectmaxdelay, and
+        randomly varied by up to reconnectjitter (a fraction of the delay),
+        so many bots don't reconnect at the same moment. the delay starts
+        over once a connection has stayed established for reconnectstable
+        seconds; until then, it also grows when the server closes the
+        connection cleanly (e.g. kills the bot right after login), so only
+        the first clean disconnect is retried right away.
+
+        text messages that are sent while the connection isn't established
+        are held back, and sent once it is: at most holdlimit messages (the
+        oldest ones are discarded first), for at most holdtime seconds.
+        holdlimit=0 discards them right away.
+
+        log messages are written by logwriter (default: the process-wide
+        LogWriter for stdout).
+
+        the connection's statistics are reported to metrics (default: the
+        process-wide Metrics registry).
         """
-        # mutex for sending raw data
-        self._sendingLock = threading.Lock()
+        # the event loop that drives this connection's I/O
+        if loop is None:
+            loop = EventLoop.defaultLoop()
+        self._loop = loop
+        # the file descriptor that is registered with the loop
+        self._fd = None
+        # pending timers of this connection; cancelled when it's stopped
+        # or closed
+        self._timers = set()
+        self._establishTimeout = establishtimeout
+        # (queueing time, message, relay origin) tuples that wait for
+        # being sent by _writeQueued(), one queue per priority class
+        self._sendQueues = (collections.deque(), collections.deque())
+        self._sendQueueLimit = sendqueuelimit
+        self._writeScheduled = False
+        # limits the rate of non-urgent messages
+        if sendrate:
+            self._rateLimit = TokenBucket.TokenBucket(sendrate, sendburst)
+        else:
+            self._rateLimit = None
+        self._rateLimitWaiting = False
+        # closes the connection if it isn't established in time
+        self._establishTimer = None
+        # round-trip times of the pings sent by subclasses
+        self._latency = LatencyStats.LatencyStats()
+        # token and send time of the unanswered ping, if any
+        self._pingPending = None
+        self._sendStats = {
+            'queued': 0,
+            'sent': 0,
+            'dropped': 0,
+            'discarded': 0,
+            'maxdepth': 0,
+            'writerblocked': 0,
+            'ratelimited': 0,
+            'queuedelaysum': 0.0,
+            'queuedelaymax': 0.0,
+        }
+        # relay origin for the messages that are currently being queued
+        self._sendOrigin = None
+        # start time of the current _listen() call
+        self._readStarted = None
+        # (queueing time, callbacks, args, relay origin) tuples that wait
+        # for being run by _runCallbacks()
+        self._callbackQueue = collections.deque()
+        self._callbackQueueLimit = callbackqueuelimit
+        self._callbackBudget = callbackbudget
+        self._callbacksScheduled = False
+        self._reconnect = reconnect
+        self._reconnectDelay = reconnectdelay
+        self._reconnectMaxDelay = reconnectmaxdelay
+        self._reconnectJitter = reconnectjitter
+        self._reconnectStable = reconnectstable
+        # attempts since the connection was last established for at least
+        # reconnectstable seconds
+        self._reconnectAttempts = 0
+        # time when the connection was established
+        self._establishedAt = None
+        # delay and timer of the pending (re)start, if any
+        self._reconnectPending = None
+        self._startTimer = None
+        # has stop() been called since the last start()?
+        self._stopped = False
+        # (holding time, message, relay origin) tuples of the text messages
+        # that wait for the connection to be established
+        self._held = collections.deque()
+        self._holdLimit = holdlimit
+        self._holdTime = holdtime
+        self._counters = {
+            'connects': 0,
+            'connectfailures': 0,
+            'disconnects': 0,
+            'textreceived': 0,
+            'textsent': 0,
+            'listenseconds': 0.0,
+            'callbackseconds': 0.0,
+            'callbacksdropped': 0,
+            'callbacksslow': 0,
+            'callbackdelaymax': 0.0,
+            'reconnects': 0,
+            'held': 0,
+            'heldflushed': 0,
+            'heldexpired': 0,
+            'heldevicted': 0,
+        }
+        # message type -> [count, bytes], for received and sent messages
+        self._received = {}
+        self._sent = {}
+        # source connection name -> Histogram of the time from the receipt
+        # of a message until its relayed copy is sent by this connection
+        self._relayLatency = {}
+        if metrics is None:
+            metrics = Metrics.defaultMetrics()
+        metrics.register(self._collectMetrics)
+
         self._loglevel = loglevel
+        if logwriter is None:
+            logwriter = LogWriter.defaultWriter()
+        self._logWriter = logwriter
+        # is the connection currently being opened by the event loop?
+        self._opening = False
         # are we currently connected, and have all initial packages been sent?
         self._connected = False
         # is the connection currently fully established?
@@ -46,6 +207,11 @@ class AbstractConnection(object):
         """
         SHOULD open sockets/files etc.
 
+        MUST NOT block: sockets SHOULD be non-blocking and connect with
+        connect_ex(). if opening can't be completed right away, returns
+        'read' or 'write'; _finishOpening() is then called once the file
+        descriptor is readable or writable.
+
         returns True IFF the connection was successfully opened.
 
         on error, returns False, or raises an exception containing a
@@ -56,9 +222,23 @@ class AbstractConnection(object):
         raise NotImplementedError("_openConnection() not implemented in " +
                                   "abstract class AbstractConnection")
 
+    def _finishOpening(self):
+        """
+        continues opening the connection (e.g. the TLS handshake) when
+        the file descriptor became ready, as requested by _openConnection()
+        or the previous call.
+
+        returns True once the connection is open, or 'read' or 'write' to
+        be called again when the file descriptor is readable or writable.
+        on error, raises an exception.
+
+        MUST be overloaded if _openConnection() doesn't always return True.
+        """
+        return True
+
     def _initConnection(self):
         """
-        SHOULD send initial packages, launch PING threads, etc.
+        SHOULD send initial packages, start PING timers, etc.
 
         returns True on success.
 
@@ -96,14 +276,25 @@ class AbstractConnection(object):
         raise NotImplementedError("_closeConnection() not implemented in " +
                                   "abstract class AbstractConnection")
 
+    def _fileno(self):
+        """
+        returns the file descriptor of the open socket/file; the event loop
+        will call _listen() whenever it becomes readable.
+
+        MUST be overloaded.
+        """
+        raise NotImplementedError("_fileno() not implemented in " +
+                                  "abstract class AbstractConnection")
+
     def _listen(self):
         """
-        Called from the main listening loop.
+        Called from the event loop whenever the socket/file is readable.
 
-        SHOULD read data from socket/file, and send responses.
+        SHOULD read the available data from socket/file, and send responses.
+        MUST NOT block waiting for further data.
 
         return False or raise an error if listening fails.
-        the loop will be cleanly terminated in that case.
+        the connection will be cleanly terminated in that case.
 
         MUST be overloaded.
         """
@@ -112,7 +303,9 @@ class AbstractConnection(object):
 
     def _sendMessageUnsafe(self, message):
         """
-        SHOULD send the message via the connection's socket/file.
+        SHOULD serialize the message into the connection's write buffer,
+        for being written by _flushUnsafe().
+        MAY write it to the socket/file directly, if that never blocks.
 
         return False or raise an error if the sending fails.
 
@@ -121,6 +314,20 @@ class AbstractConnection(object):
         raise NotImplementedError("_sendMessageUnsafe() not implemented in " +
                                   "abstract class AbstractConnection")
 
+    def _flushUnsafe(self):
+        """
+        SHOULD write as much of the write buffer to the socket/file as
+        possible without blocking.
+
+        returns True once the buffer is empty; False if the socket/file
+        is not ready to take more data.
+
+        raise an error if the writing fails.
+
+        MAY be overloaded.
+        """
+        return True
+
     def _sendTextMessageUnsafe(self, message):
         """
         Sends a text message.
@@ -149,34 +356,139 @@ class AbstractConnection(object):
     def registerConnectionFailedCallback(self, function):
         self._connectionFailedCallback.append(function)
 
+    def _invokeCallbacks(self, callbacks, *args, **kwargs):
+        """
+        queues the invocation of the callbacks with args; they are run by
+        _runCallbacks() from the event loop.
+
+        the relayorigin keyword argument is the _relayOrigin while they run.
+        """
+        if not callbacks:
+            return
+        self._callbackQueue.append((time.time(), callbacks, args,
+                                    kwargs.get('relayorigin')))
+        if not self._callbacksScheduled:
+            self._callbacksScheduled = True
+            self._loop.callSoon(self._runCallbacks)
+
+    def _runCallbacks(self):
+        """
+        runs the queued callbacks in order, for at most CALLBACK_SLICE
+        seconds; the rest is left for the next loop iteration.
+        """
+        global _relayOrigin
+        self._callbacksScheduled = False
+        queue = self._callbackQueue
+        counters = self._counters
+        sliceEnd = time.time() + CALLBACK_SLICE
+        while queue:
+            queued, callbacks, args, origin = queue.popleft()
+            started = time.time()
+            counters['callbackdelaymax'] = max(counters['callbackdelaymax'],
+                                               started - queued)
+            _relayOrigin = origin
+            try:
+                for f in callbacks:
+                    self._runCallback(f, args)
+            finally:
+                _relayOrigin = None
+            if queue and time.time() >= sliceEnd:
+                self._callbacksScheduled = True
+                self._loop.callSoon(self._runCallbacks)
+                return
+
+    def _runCallback(self, f, args):
+        started = time.time()
+        try:
+            f(*args)
+        except:
+            self._logException("uncaught exception in callback %r" % f, 0)
+        finally:
+            duration = time.time() - started
+            self._counters['callbackseconds'] += duration
+            if duration > self._callbackBudget:
+                self._counters['callbacksslow'] += 1
+                self._log("callback %r took %.3f seconds", 1, f, duration,
+                          budget=self._callbackBudget)
+
     def _invokeTextCallback(self, sender, message):
-        for f in self._textCallback:
-            f(sender, message)
+        self._counters['textreceived'] += 1
+        if not self._textCallback:
+            return
+        if len(self._callbackQueue) >= self._callbackQueueLimit:
+            self._counters['callbacksdropped'] += 1
+            self._log("callback queue full, dropping text message", 1,
+                      sender=sender)
+            return
+        self._invokeCallbacks(self._textCallback, sender, message,
+                              relayorigin=(self._name,
+                                           self._readStarted or time.time()))
 
     def _invokeConnectionEstablishedCallback(self):
-        for f in self._connectionEstablishedCallback:
-            f()
+        self._invokeCallbacks(self._connectionEstablishedCallback)
 
     def _invokeConnectionLostCallback(self):
-        for f in self._connectionLostCallback:
-            f()
+        self._counters['disconnects'] += 1
+        self._invokeCallbacks(self._connectionLostCallback)
 
     def _invokeConnectionFailedCallback(self):
-        for f in self._connectionFailedCallback:
-            f()
+        self._counters['connectfailures'] += 1
+        self._invokeCallbacks(self._connectionFailedCallback)
 
     def start(self):
         """
-        call this to start the connection, as a thread.
+        call this to start the connection in the event loop.
+        """
+        self._stopped = False
+        self._loop.callSoon(self._connect)
+
+    def startLater(self, delay):
+        """
+        call this to start the connection after delay seconds, e.g. to
+        reconnect. stop() cancels the pending start; another startLater()
+        replaces it.
         """
-        thread.start_new_thread(self.run, ())
+        self._scheduleStart(delay, self.start)
+
+    def _scheduleStart(self, delay, function):
+        """
+        schedules the (re)start of the connection, replacing the pending
+        one, if any.
+        """
+        if self._startTimer is not None:
+            self._startTimer.cancel()
+        self._reconnectPending = delay
+        self._startTimer = self._callLater(delay, self._startNow, function)
+
+    def _startNow(self, function):
+        self._reconnectPending = None
+        self._startTimer = None
+        function()
+
+    def restart(self, delay):
+        """
+        call this to terminate the connection, and start it again after
+        delay seconds.
+        """
+        self.stop()
+        # the start must be scheduled once the connection is closed, which
+        # cancels all of its timers.
+        self._loop.callSoon(self.startLater, delay)
 
     def stop(self):
         """
-        call this to terminate the connection.
+        call this to terminate the connection; it isn't reconnected.
         """
-        self._connected = False
-        self._established = False
+        self._stopped = True
+        self._cancelTimers()
+        if self._opening:
+            self._opening = False
+            self._log("connection attempt aborted", 1)
+            self._closeOpening()
+        elif self._connected:
+            self._connected = False
+            self._established = False
+            self._loop.callSoon(self._disconnect, True)
 
     def _connectionEstablished(self):
         """
@@ -186,35 +498,230 @@ class AbstractConnection(object):
         if not self._connected:
             raise Exception("connection can't be established, since it's " +
                             "not even connected")
+        if not self._established:
+            self._establishedAt = time.time()
         self._established = True
+        if self._establishTimer is not None:
+            self._establishTimer.cancel()
+            self._establishTimer = None
+        self._flushHeld()
         self._invokeConnectionEstablishedCallback()
 
+    def _callLater(self, delay, function, *args):
+        """
+        invokes function(*args) from the event loop after delay seconds,
+        unless the connection is stopped or closed before.
+
+        returns the EventLoop.Timer.
+        """
+        def fire():
+            self._timers.discard(timer)
+            function(*args)
+
+        timer = self._loop.callLater(delay, fire)
+        self._timers.add(timer)
+        return timer
+
+    def _cancelTimers(self):
+        for timer in self._timers:
+            timer.cancel()
+        self._timers.clear()
+        self._establishTimer = None
+        self._reconnectPending = None
+        self._startTimer = None
+        self._rateLimitWaiting = False
+
+    def _scheduleReconnect(self, clean):
+        """
+        schedules the next connection attempt, if reconnecting is enabled
+        and the connection hasn't been stopped.
+        """
+        if not self._reconnect or self._stopped:
+            return
+        if clean and self._reconnectAttempts == 0:
+            # the server closed the established connection in an orderly
+            # way (e.g. it was restarted); the next attempt is likely to
+            # succeed.
+            delay = 0
+        else:
+            delay = min(self._reconnectDelay * 2 ** self._reconnectAttempts,
+                        self._reconnectMaxDelay)
+            delay *= 1 + random.uniform(-self._reconnectJitter,
+                                        self._reconnectJitter)
+        self._reconnectAttempts += 1
+        self._counters['reconnects'] += 1
+        self._log("reconnecting in %.1f seconds", 1, delay,
+                  attempt=self._reconnectAttempts)
+        self._scheduleStart(delay, self._connect)
+
+    def reconnectDelay(self):
+        """
+        returns the delay in seconds after which the connection is
+        reconnected, or None if no reconnect is pending.
+        """
+        return self._reconnectPending
+
+    def _pingSent(self, token, now):
+        """
+        SHOULD be called by subclasses whenever they send a ping whose
+        answer echoes token; the previous ping counts as lost if it's
+        still unanswered.
+        """
+        if self._pingPending is not None:
+            self._latency.addLost()
+        self._pingPending = (token, now)
+
+    def _pongReceived(self, token):
+        """
+        SHOULD be called by subclasses with the token of a received ping
+        answer; returns the round-trip time in seconds, or None if the
+        answer doesn't belong to the last ping.
+        """
+        if self._pingPending is None or self._pingPending[0] != token:
+            return None
+        rtt = time.time() - self._pingPending[1]
+        self._pingPending = None
+        self._latency.add(rtt)
+        return rtt
+
+    def latencyStats(self):
+        """
+        returns a dict of ping round-trip time statistics, see
+        LatencyStats.stats().
+        """
+        return self._latency.stats()
+
+    def latencySummary(self):
+        """
+        returns the ping round-trip time statistics as a line of text.
+        """
+        return self._latency.summary()
+
+    def _onEstablishTimeout(self):
+        self._establishTimer = None
+        if self._opening:
+            self._openFailed("connection not opened after %s seconds" %
+                             self._establishTimeout)
+        elif self._connected and not self._established:
+            self._log("connection not established after %s seconds", 0,
+                      self._establishTimeout)
+            self._disconnect(False)
+
     def run(self):
         """
-        opens and initializes the connection, contains the listening loop,
-        and closes the connection.
+        starts the connection, and runs the event loop until it is stopped.
         """
+        self.start()
+        self._loop.run()
+
+    def _connect(self):
+        """
+        starts opening the connection; once it is open, _opened()
+        initializes it and registers it with the event loop.
+
+        does nothing if the connection is already open or being opened.
+        """
+        if self._opening or self._connected or self._fd is not None:
+            self._log("already connected, not connecting again", 2)
+            return
+        self._counters['connects'] += 1
         try:
-            if not self._openConnection():
+            result = self._openConnection()
+            if not result:
                 raise Exception("unknown error")
         except:
-            self._log("connection could not be opened:\n" +
-                      str(sys.exc_info()[0]), 0)
-            self._log(traceback.format_exc(), 1)
+            self._log("connection could not be opened:\n%s", 0,
+                      sys.exc_info()[0])
+            if self._logEnabled(1):
+                self._log(traceback.format_exc(), 1)
+            self._scheduleReconnect(False)
             self._invokeConnectionFailedCallback()
             return
+
+        self._fd = self._fileno()
+        # the establish timeout includes the time needed for opening.
+        if self._establishTimeout:
+            self._establishTimer = self._callLater(self._establishTimeout,
+                                                   self._onEstablishTimeout)
+        if result is True:
+            self._opened()
+        else:
+            self._opening = True
+            self._waitOpening(result)
+
+    def _waitOpening(self, result):
+        """
+        makes the event loop call _continueOpening() when the file
+        descriptor becomes ready as requested by result ('read'/'write').
+        """
+        # the file descriptor changes if _finishOpening() had to start over
+        # with a new socket.
+        self._loop.removeReader(self._fd)
+        self._loop.removeWriter(self._fd)
+        self._fd = self._fileno()
+        if result == 'read':
+            self._loop.addReader(self._fd, self._continueOpening)
+        elif result == 'write':
+            self._loop.addWriter(self._fd, self._continueOpening)
         else:
-            self._log("connection successfully opened", 2)
+            raise Exception("invalid opening state: %r" % (result,))
 
+    def _continueOpening(self):
+        try:
+            result = self._finishOpening()
+            if not result:
+                raise Exception("unknown error")
+            if result is not True:
+                self._waitOpening(result)
+                return
+        except:
+            self._openFailed("connection could not be opened: %s" %
+                             sys.exc_info()[0])
+            if self._logEnabled(1):
+                self._log(traceback.format_exc(), 1)
+            return
+
+        self._opening = False
+        self._loop.removeReader(self._fd)
+        self._loop.removeWriter(self._fd)
+        self._opened()
+
+    def _openFailed(self, message):
+        """
+        gives up the connection attempt that is in progress.
+        """
+        self._opening = False
+        self._log(message, 0)
+        self._closeOpening()
+        self._scheduleReconnect(False)
+        self._invokeConnectionFailedCallback()
+
+    def _closeOpening(self):
+        """
+        closes the connection that is being opened, and unregisters it.
+        """
+        try:
+            self._closeConnection()
+        except:
+            pass
+        self._unregister()
+
+    def _opened(self):
+        """
+        initializes the open connection, and registers it with the event
+        loop.
+        """
+        self._log("connection successfully opened", 2)
+
+        # messages that are sent from _initConnection() are written
+        # as soon as the socket is writable.
         try:
             if not self._initConnection():
                 raise Exception("unknown error")
         except:
             self._logException("initial packages could not be sent", 1)
-            try:
-                self._closeConnection()
-            except:
-                pass
+            self._closeOpening()
+            self._scheduleReconnect(False)
             self._invokeConnectionFailedCallback()
             return
         else:
@@ -230,18 +737,55 @@ class AbstractConnection(object):
             # ... for example from _postConnect()!
             if not self._postConnect():
                 raise Exception("postConnect error")
+        except:
+            self._logException("connection terminated with error", 0)
+            self._disconnect(False)
+            return
+
+        # you may even call it from inside _listen() once that auth
+        # confirm arrives.
+        self._loop.addReader(self._fd, self._onReadable)
 
-            # you may even call it from inside _listen() once that auth
-            # confirm arrives.
-            while self._connected:
+    def _onReadable(self):
+        """
+        invoked by the event loop when there is data to be read.
+        """
+        self._readStarted = time.time()
+        try:
+            try:
                 if not self._listen():
                     raise Exception("listening error")
-
+            finally:
+                self._counters['listenseconds'] += (time.time() -
+                                                    self._readStarted)
+                self._readStarted = None
         except:
             self._logException("connection terminated with error", 0)
-        else:
+            self._disconnect(False)
+            return
+
+        if not self._connected:
+            # the connection was closed from inside _listen().
+            self._disconnect(True)
+
+    def _disconnect(self, clean):
+        """
+        closes the connection, unregisters it from the event loop,
+        and invokes the connectionLost callbacks.
+        """
+        if self._fd is None:
+            # already disconnected.
+            return
+
+        if clean:
             self._log("connection terminated without error", 1)
 
+        # only established connections are reconnected right away.
+        wasEstablished = self._established
+        if (wasEstablished and
+                time.time() - self._establishedAt >= self._reconnectStable):
+            # the connection was fine; start over with the delays.
+            self._reconnectAttempts = 0
         self._established = False
         self._connected = False
 
@@ -254,49 +798,388 @@ class AbstractConnection(object):
         else:
             self._log("socket successfully closed", 2)
 
+        self._unregister()
+        self._scheduleReconnect(clean and wasEstablished)
+
         # invoke the connectionLost callback functions.
         self._invokeConnectionLostCallback()
 
-    def _sendMessage(self, message):
+    def _unregister(self):
         """
-        sends a message, taking care of thread-safety and error handling.
-        calls _sendMessageUnsafe to do the actual job; overload that.
+        removes the connection from the event loop, cancels its timers,
+        and discards all messages that have not been sent yet.
         """
-        with self._sendingLock:
-            try:
-                # synchronized gschichten.
-                if not self._sendMessageUnsafe(message):
-                    return False
-            except:
-                self._logException("could not send message", 1)
-                self._connected = False
-                return False
-            return True
+        self._loop.removeReader(self._fd)
+        self._loop.removeWriter(self._fd)
+        self._fd = None
+        self._cancelTimers()
+        self._pingPending = None
+        for queue in self._sendQueues:
+            self._sendStats['discarded'] += len(queue)
+            queue.clear()
+
+    def _sendMessage(self, message, priority=PRIORITY_NORMAL):
+        """
+        queues a message for sending, and returns immediately.
+        the message is sent by _writeQueued() from the event loop.
+
+        returns False if the message was dropped because the send queue
+        is full.
+        """
+        depth = self._sendQueueDepth()
+        if depth >= self._sendQueueLimit and priority != PRIORITY_URGENT:
+            self._sendStats['dropped'] += 1
+            self._log("send queue full, dropping message", 1)
+            return False
+
+        self._sendQueues[priority].append((time.time(), message,
+                                           self._sendOrigin))
+        self._sendStats['queued'] += 1
+        if depth + 1 > self._sendStats['maxdepth']:
+            self._sendStats['maxdepth'] = depth + 1
+
+        self._scheduleWrite()
+        return True
+
+    def _sendQueueDepth(self):
+        return sum(len(queue) for queue in self._sendQueues)
+
+    def _scheduleWrite(self):
+        if not self._writeScheduled:
+            self._writeScheduled = True
+            self._loop.callSoon(self._writeQueued)
+
+    def _rateLimitExpired(self):
+        self._rateLimitWaiting = False
+        self._scheduleWrite()
+
+    def _popSendQueue(self, now):
+        """
+        returns the (queueing time, message, relay origin) tuple of the
+        next message that may be sent now, by priority, or None.
+
+        if the rate limit forbids sending, schedules _writeQueued() for the
+        time when it will allow it again.
+        """
+        for priority, queue in enumerate(self._sendQueues):
+            if not queue:
+                continue
+
+            if self._rateLimit is not None:
+                if priority == PRIORITY_URGENT:
+                    self._rateLimit.force(now)
+                else:
+                    wait = self._rateLimit.take(now)
+                    if wait:
+                        if not self._rateLimitWaiting:
+                            self._rateLimitWaiting = True
+                            self._sendStats['ratelimited'] += 1
+                            self._callLater(wait, self._rateLimitExpired)
+                        return None
+
+            entry = queue.popleft()
+            delay = now - entry[0]
+            self._sendStats['queuedelaysum'] += delay
+            if delay > self._sendStats['queuedelaymax']:
+                self._sendStats['queuedelaymax'] = delay
+            return entry
+
+        return None
+
+    def _writeQueued(self):
+        """
+        serializes queued messages into the write buffer and flushes it,
+        until the queue is empty, the rate limit is reached, or the
+        socket/file doesn't take more data; in that case, the event loop
+        calls this again once it's writable.
+
+        calls _sendMessageUnsafe and _flushUnsafe to do the actual job;
+        overload those.
+        """
+        self._writeScheduled = False
+        if self._fd is None:
+            return
+
+        try:
+            while True:
+                # serialize a limited batch, so that a slow socket makes
+                # messages wait in the (bounded) queue instead of the buffer.
+                now = time.time()
+                count = 0
+                while count < 64:
+                    entry = self._popSendQueue(now)
+                    if entry is None:
+                        break
+                    if not self._sendMessageUnsafe(entry[1]):
+                        raise Exception("unknown error")
+                    self._sendStats['sent'] += 1
+                    if entry[2] is not None:
+                        self._observeRelay(entry[2], now)
+                    count += 1
+
+                if not self._flushUnsafe():
+                    self._sendStats['writerblocked'] += 1
+                    self._loop.addWriter(self._fd, self._writeQueued)
+                    return
+
+                self._loop.removeWriter(self._fd)
+                if count < 64:
+                    # the queue is empty, or the rate limit was reached.
+                    return
+        except:
+            self._logException("could not send message", 1)
+            self._connected = False
+            self._disconnect(False)
+
+    def _drainSendQueue(self):
+        """
+        best-effort attempt to write all queued messages right now,
+        ignoring the rate limit, e.g. from _closeConnection().
+        """
+        try:
+            for queue in self._sendQueues:
+                while queue:
+                    self._sendMessageUnsafe(queue.popleft()[1])
+                    self._sendStats['sent'] += 1
+            self._flushUnsafe()
+        except:
+            self._logException("could not drain send queue", 2)
+
+    def sendQueueStats(self):
+        """
+        returns a dict of send queue statistics:
+        current depth, maximum depth, and the numbers of queued, sent,
+        dropped (queue full) and discarded (connection lost) messages,
+        how often the writer had to wait for the socket or the rate limit,
+        and the average and maximum time messages spent in the queue.
+        """
+        stats = dict(self._sendStats)
+        stats['depth'] = self._sendQueueDepth()
+        sent = max(1, stats['sent'])
+        stats['queuedelayavg'] = stats['queuedelaysum'] / sent
+        return stats
 
     def sendTextMessage(self, message):
         """
-        sends a text message, taking care of thread-safety and error
-        handling.
+        sends a text message, taking care of error handling.
+        returns immediately; the message is sent from the event loop.
         calls _sendTextMessageUnsafe to do the actual job; overload
         that. From _sendTextMessageUnsafe, _sendMessage MUST be
         called.
+
+        if the connection isn't established, the message is held back
+        until it is.
         """
+        if not self._established and not self._stopped and self._holdLimit:
+            self._hold(message)
+            return
+        self._sendText(message, _relayOrigin)
+
+    def _sendText(self, message, origin):
         try:
             if not self._established:
                 raise Exception("connection not established")
-            if not self._sendTextMessageUnsafe(message):
-                raise Exception("unknown error")
+            self._sendOrigin = origin
+            try:
+                if not self._sendTextMessageUnsafe(message):
+                    raise Exception("unknown error")
+            finally:
+                self._sendOrigin = None
+            self._counters['textsent'] += 1
         except:
             self._logException("could not send text message", 1)
 
-    def _log(self, message, level):
-        if(self._loglevel >= level):
-            for line in message.split('\n'):
-                output = "(" + str(level) + ") " + self._name + ":"
-                output = output.ljust(15)
-                output = output + util.try_encode(line, 'utf-8')
-                print(output)
+    def _hold(self, message):
+        now = time.time()
+        self._expireHeld(now)
+        if len(self._held) >= self._holdLimit:
+            self._held.popleft()
+            self._counters['heldevicted'] += 1
+        self._held.append((now, message, _relayOrigin))
+        self._counters['held'] += 1
+        self._log("connection not established, holding text message", 2,
+                  held=len(self._held))
+
+    def _expireHeld(self, now):
+        held = self._held
+        while held and now - held[0][0] > self._holdTime:
+            held.popleft()
+            self._counters['heldexpired'] += 1
+
+    def _flushHeld(self):
+        """
+        sends the held text messages, oldest first; they are queued like
+        all others, so the rate limit applies.
+        """
+        self._expireHeld(time.time())
+        if not self._held:
+            return
+        self._log("sending %d held text messages", 1, len(self._held))
+        while self._held:
+            _, message, origin = self._held.popleft()
+            self._counters['heldflushed'] += 1
+            self._sendText(message, origin)
+
+    def _countReceived(self, messagetype, size, count=1):
+        """
+        SHOULD be called by subclasses for every received message, with
+        its type (e.g. the mumble message type name) and size in bytes.
+
+        count > 1 adds several messages at once; size is their total size.
+        """
+        entry = self._received.get(messagetype)
+        if entry is None:
+            entry = self._received[messagetype] = [0, 0]
+        entry[0] += count
+        entry[1] += size
+
+    def _countSent(self, messagetype, size):
+        """
+        SHOULD be called by subclasses for every sent message, like
+        _countReceived().
+        """
+        entry = self._sent.get(messagetype)
+        if entry is None:
+            entry = self._sent[messagetype] = [0, 0]
+        entry[0] += 1
+        entry[1] += size
+
+    def _observeRelay(self, origin, now):
+        source, received = origin
+        histogram = self._relayLatency.get(source)
+        if histogram is None:
+            histogram = self._relayLatency[source] = Metrics.Histogram()
+        histogram.observe(now - received)
+
+    def _collectMetrics(self):
+        """
+        returns the connection's metric families, see Metrics.Metrics.
+        """
+        labels = {'connection': self._name}
+        counters = self._counters
+        sendStats = self.sendQueueStats()
+        latency = self._latency
+
+        def traffic(table, index):
+            return [('', dict(labels, type=messagetype), entry[index])
+                    for messagetype, entry in sorted(table.items())]
+
+        def single(value):
+            return [('', labels, value)]
+
+        relay = []
+        for source, histogram in sorted(self._relayLatency.items()):
+            relay.extend(histogram.samples({'source': source,
+                                            'destination': self._name}))
+
+        return [
+            ('sftbot_messages_received_total', 'counter',
+             "received protocol messages", traffic(self._received, 0)),
+            ('sftbot_message_bytes_received_total', 'counter',
+             "size of the received protocol messages",
+             traffic(self._received, 1)),
+            ('sftbot_messages_sent_total', 'counter',
+             "sent protocol messages", traffic(self._sent, 0)),
+            ('sftbot_message_bytes_sent_total', 'counter',
+             "size of the sent protocol messages", traffic(self._sent, 1)),
+            ('sftbot_text_messages_received_total', 'counter',
+             "received chat messages", single(counters['textreceived'])),
+            ('sftbot_text_messages_sent_total', 'counter',
+             "sent chat messages", single(counters['textsent'])),
+            ('sftbot_connected', 'gauge',
+             "whether the connection is connected",
+             single(int(self._connected))),
+            ('sftbot_established', 'gauge',
+             "whether the connection is established",
+             single(int(self._established))),
+            ('sftbot_connects_total', 'counter',
+             "connection attempts", single(counters['connects'])),
+            ('sftbot_connect_failures_total', 'counter',
+             "failed connection attempts",
+             single(counters['connectfailures'])),
+            ('sftbot_disconnects_total', 'counter',
+             "lost connections", single(counters['disconnects'])),
+            ('sftbot_reconnects_total', 'counter',
+             "scheduled reconnects", single(counters['reconnects'])),
+            ('sftbot_reconnect_attempts', 'gauge',
+             "reconnects since the connection was last established for "
+             "long enough", single(self._reconnectAttempts)),
+            ('sftbot_held_messages', 'gauge',
+             "text messages held back until the connection is established",
+             single(len(self._held))),
+            ('sftbot_held_messages_total', 'counter',
+             "text messages that were held back", single(counters['held'])),
+            ('sftbot_held_messages_flushed_total', 'counter',
+             "held text messages that were sent",
+             single(counters['heldflushed'])),
+            ('sftbot_held_messages_expired_total', 'counter',
+             "held text messages that were discarded because of their age",
+             single(counters['heldexpired'])),
+            ('sftbot_held_messages_evicted_total', 'counter',
+             "held text messages that were discarded for newer ones",
+             single(counters['heldevicted'])),
+            ('sftbot_send_queue_depth', 'gauge',
+             "messages waiting for being sent", single(sendStats['depth'])),
+            ('sftbot_send_queue_dropped_total', 'counter',
+             "messages dropped because the send queue was full",
+             single(sendStats['dropped'])),
+            ('sftbot_send_queue_delay_seconds_max', 'gauge',
+             "longest time a message spent in the send queue",
+             single(sendStats['queuedelaymax'])),
+            ('sftbot_listen_seconds_total', 'counter',
+             "time spent handling received data",
+             single(counters['listenseconds'])),
+            ('sftbot_callback_seconds_total', 'counter',
+             "time spent in callbacks", single(counters['callbackseconds'])),
+            ('sftbot_callback_queue_depth', 'gauge',
+             "events waiting for their callbacks",
+             single(len(self._callbackQueue))),
+            ('sftbot_callback_queue_dropped_total', 'counter',
+             "text messages dropped because the callback queue was full",
+             single(counters['callbacksdropped'])),
+            ('sftbot_callback_queue_delay_seconds_max', 'gauge',
+             "longest time an event waited for its callbacks",
+             single(counters['callbackdelaymax'])),
+            ('sftbot_callbacks_slow_total', 'counter',
+             "callbacks that took longer than the callback budget",
+             single(counters['callbacksslow'])),
+            ('sftbot_ping_rtt_seconds_avg', 'gauge',
+             "average ping round-trip time", single(latency.average())),
+            ('sftbot_pings_total', 'counter',
+             "answered pings", single(latency.count)),
+            ('sftbot_pings_lost_total', 'counter',
+             "unanswered pings", single(latency.lost)),
+            ('sftbot_relay_latency_seconds', 'histogram',
+             "time from the receipt of a chat message until its relayed "
+             "copy is sent", relay),
+        ]
+
+    def _logEnabled(self, level):
+        return self._loglevel >= level
+
+    def _log(self, message, level, *args, **fields):
+        """
+        logs message % args, followed by the fields as key=value pairs,
+        if level is enabled.
+
+        nothing is formatted if it isn't; so instead of building the
+        string beforehand, pass the values:
+            self._log("rx: %s", 3, line, size=len(line))
+        """
+        if self._loglevel < level:
+            return
+        if args:
+            message = message % args
+        if fields:
+            message += " [" + " ".join("%s=%s" % (key, fields[key])
+                                       for key in sorted(fields)) + "]"
+
+        prefix = ("(" + str(level) + ") " + self._name + ":").ljust(15)
+        for line in message.split('\n'):
+            self._logWriter.write(prefix + util.try_encode(line, 'utf-8'))
 
     def _logException(self, message, level):
-        self._log(message + ": " + str(sys.exc_info()[0]), level)
+        if self._loglevel < level:
+            return
+        self._log("%s: %s", level, message, sys.exc_info()[0])
         self._log(traceback.format_exc(), level + 1)
@@ -1,21 +1,29 @@
 import AbstractConnection
+import os
 import sys
 import string
 import util
+import LineReader
 
 
 class ConsoleConnection(AbstractConnection.AbstractConnection):
-    def __init__(self, encoding, name, loglevel):
+    def __init__(self, encoding, name, loglevel, **kwargs):
         """
         just store the encoding.
+
+        output goes through the log writer, so it doesn't block the event
+        loop, and stays in order with the log messages.
         """
-        super(ConsoleConnection, self).__init__(name, loglevel)
+        super(ConsoleConnection, self).__init__(name, loglevel, **kwargs)
         self._encoding = encoding
+        # splits the input into lines
+        self._lineReader = None
 
     def _openConnection(self):
         """
         there is nothing to open; all we need is stdout/stdin.
         """
+        self._lineReader = LineReader.LineReader()
         return True
 
     def _initConnection(self):
@@ -32,19 +40,24 @@ class ConsoleConnection(AbstractConnection.AbstractConnection):
         """
         return True
 
+    def _fileno(self):
+        return sys.stdin.fileno()
+
     def _listen(self):
         """
-        read data from stdin, and interpret it as a chat message
+        read data from stdin, and interpret each line as a chat message.
+
+        the data is read from the file descriptor directly: lines that
+        sys.stdin had buffered would be invisible to select().
         """
-        try:
-            line = sys.stdin.readline()
-        except KeyboardInterrupt:
-            self._log("keyboard interrupt", 1)
-            self._invokeTextCallback("console", "Goodbye.")
+        data = os.read(self._fileno(), 4096)
+        if not data:
+            self._log("end of input", 1)
             return False
 
-        line = util.try_decode(line, self._encoding)
-        self._invokeTextCallback("console", line)
+        for line in self._lineReader.feed(data):
+            line = util.try_decode(line, self._encoding)
+            self._invokeTextCallback("console", line)
         return True
 
     # send the given line to stdout.
@@ -52,7 +65,7 @@ class ConsoleConnection(AbstractConnection.AbstractConnection):
         """
         write the message to stdout
         """
-        print(util.try_encode(message, self._encoding))
+        self._logWriter.write(util.try_encode(message, self._encoding))
         return True
 
     # pass the given line to _sendMessage.
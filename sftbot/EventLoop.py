@@ -0,0 +1,200 @@
+import sys
+import time
+import heapq
+import select
+import traceback
+import collections
+
+
+class Timer(object):
+    """
+    handle for a call that was scheduled by EventLoop.callLater().
+    """
+    __slots__ = ('deadline', 'function', 'args', 'cancelled', '_loop')
+
+    def __init__(self, loop, deadline, function, args):
+        self._loop = loop
+        self.deadline = deadline
+        self.function = function
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        """
+        prevents the call, if it hasn't happened yet.
+        """
+        self._loop.cancelTimer(self)
+
+
+class EventLoop(object):
+    """
+    single-threaded select()-based event loop.
+
+    all connections register their file descriptors here; the loop invokes
+    their read handlers whenever data is available, and runs deferred
+    calls and timers in between. everything runs in the thread that calls
+    run(), so connection code needs no locking.
+    """
+
+    def __init__(self):
+        # fd -> callback
+        self._readers = {}
+        self._writers = {}
+        # calls that should be run during the next iteration
+        self._ready = collections.deque()
+        # heap of (deadline, sequence number, Timer); cancelled timers stay
+        # in the heap until they reach its top, or until they make up
+        # more than half of it.
+        self._timers = []
+        self._timerSeq = 0
+        self._cancelledTimers = 0
+        self._running = False
+
+    def addReader(self, fd, function):
+        """
+        invoke function() whenever fd becomes readable.
+        """
+        self._readers[fd] = function
+
+    def removeReader(self, fd):
+        self._readers.pop(fd, None)
+
+    def addWriter(self, fd, function):
+        """
+        invoke function() whenever fd becomes writable.
+        """
+        self._writers[fd] = function
+
+    def removeWriter(self, fd):
+        self._writers.pop(fd, None)
+
+    def callSoon(self, function, *args):
+        """
+        invoke function(*args) during the next loop iteration.
+        """
+        self._ready.append((function, args))
+
+    def callLater(self, delay, function, *args):
+        """
+        invoke function(*args) after delay seconds.
+
+        returns a Timer, whose cancel() method prevents the call.
+        """
+        timer = Timer(self, time.time() + delay, function, args)
+        self._timerSeq += 1
+        heapq.heappush(self._timers, (timer.deadline, self._timerSeq, timer))
+        return timer
+
+    def cancelTimer(self, timer):
+        """
+        cancels the timer that was returned by callLater().
+        """
+        if timer.cancelled or timer.function is None:
+            # already cancelled, or already run.
+            return
+        timer.cancelled = True
+        # release the references right away.
+        timer.function = timer.args = None
+        self._cancelledTimers += 1
+        if (self._cancelledTimers > 64 and
+                self._cancelledTimers * 2 > len(self._timers)):
+            self._timers = [entry for entry in self._timers
+                            if not entry[2].cancelled]
+            heapq.heapify(self._timers)
+            self._cancelledTimers = 0
+
+    def _popCancelledTimers(self):
+        while self._timers and self._timers[0][2].cancelled:
+            heapq.heappop(self._timers)
+            self._cancelledTimers -= 1
+
+    def stop(self):
+        """
+        makes run() return after the current iteration.
+        """
+        self._running = False
+
+    def run(self):
+        """
+        runs the loop until stop() is called.
+        """
+        self._running = True
+        while self._running:
+            self._runOnce()
+
+    def _runOnce(self):
+        # cancelled timers must not cause wakeups.
+        self._popCancelledTimers()
+        if self._ready:
+            timeout = 0
+        elif self._timers:
+            timeout = max(0, self._timers[0][0] - time.time())
+        else:
+            timeout = None
+
+        if self._readers or self._writers:
+            try:
+                readable, writable, _ = select.select(
+                    list(self._readers), list(self._writers), [], timeout)
+            except select.error as e:
+                # EINTR
+                if e.args[0] != 4:
+                    raise
+                readable, writable = [], []
+        else:
+            if timeout is None:
+                # nothing left that could ever wake us up.
+                self._running = False
+                return
+            time.sleep(timeout)
+            readable, writable = [], []
+
+        for fd in writable:
+            # the writer may have been removed by a previous handler.
+            function = self._writers.get(fd)
+            if function is not None:
+                self._invoke(function, ())
+
+        for fd in readable:
+            # the reader may have been removed by a previous handler.
+            function = self._readers.get(fd)
+            if function is not None:
+                self._invoke(function, ())
+
+        now = time.time()
+        self._popCancelledTimers()
+        while self._timers and self._timers[0][0] <= now:
+            _, _, timer = heapq.heappop(self._timers)
+            self._ready.append((timer.function, timer.args))
+            # the call can't be cancelled anymore.
+            timer.function = timer.args = None
+            self._popCancelledTimers()
+
+        # only run the calls that were ready at the start; calls that are
+        # scheduled by these will run during the next iteration.
+        for _ in range(len(self._ready)):
+            function, args = self._ready.popleft()
+            self._invoke(function, args)
+
+    def _invoke(self, function, args):
+        try:
+            function(*args)
+        except KeyboardInterrupt:
+            raise
+        except:
+            print("event loop: uncaught exception in " + repr(function) +
+                  ": " + str(sys.exc_info()[0]))
+            traceback.print_exc()
+
+
+_defaultLoop = None
+
+
+def defaultLoop():
+    """
+    returns the process-wide event loop, creating it if required.
+    """
+    global _defaultLoop
+    if _defaultLoop is None:
+        _defaultLoop = EventLoop()
+    return _defaultLoop
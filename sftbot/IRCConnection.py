@@ -1,14 +1,29 @@
 import AbstractConnection
 import sys
+import time
 import socket
 import string
 import util
+import LineReader
+import LineDecoder
+import WriteBuffer
+
+
+def nickOf(line):
+    """
+    returns the nick of a received line ':nick!user@host COMMAND ...',
+    or None if the line has no source.
+    """
+    if line.startswith(b':'):
+        return line[1:line.find(b' ')].split(b'!', 1)[0]
+    return None
 
 
 class IRCConnection(AbstractConnection.AbstractConnection):
     def __init__(self, hostname, port, nickname, channel, password,
-                 authtype, encoding, name, loglevel):
-        super(IRCConnection, self).__init__(name, loglevel)
+                 authtype, encoding, name, loglevel, maxlinelength=8192,
+                 **kwargs):
+        super(IRCConnection, self).__init__(name, loglevel, **kwargs)
         self._hostname = hostname
         self._port = port
         self._nickname = nickname
@@ -21,21 +36,41 @@ class IRCConnection(AbstractConnection.AbstractConnection):
 
         self._encoding = encoding
         self._socket = None
+        # contains all sent, but not yet written data
+        self._writer = None
+        # our nick!user@host, as seen by others
+        self._hostmask = None
 
-        # contains all read, but uninterpreted data
-        self._readBuffer = ""
+        # splits the received data into lines
+        self._maxLineLength = maxlinelength
+        self._lineReader = None
+        # decodes the received lines, remembering each nick's encoding
+        self._decoder = LineDecoder.LineDecoder(encoding, sourceof=nickOf)
         self.welcomemsg_received = False
 
     def _openConnection(self):
-        self._socket = socket.socket()
-        self._socket.connect((self._hostname, self._port))
+        """
+        starts connecting; _finishOpening() is called once the socket is
+        writable.
+        """
+        self._socket = util.start_connect(self._hostname, self._port)
+        return 'write'
+
+    def _finishOpening(self):
+        util.finish_connect(self._socket)
         return True
 
     def _initConnection(self):
         """
         send initial packages:
-            NICKname, USER identification, channel JOIN
+            NICKname, USER identification
+
+        the channel JOIN is sent by _joinChannel().
         """
+        self.welcomemsg_received = False
+        self._hostmask = None
+        self._lineReader = LineReader.LineReader(self._maxLineLength)
+        self._writer = WriteBuffer.WriteBuffer(4096)
 
         if self._authtype == 'pass':
             if not self._sendMessage("PASS %s" % self._password):
@@ -48,11 +83,15 @@ class IRCConnection(AbstractConnection.AbstractConnection):
                                   self._nickname)):
             raise Exception("could not send USER message.")
 
-        # wait for the welcome message
+        # the channel will be joined once the welcome message arrives.
         self._log("waiting for IRC welcome message 001...", 2)
-        while not self.welcomemsg_received:
-            self._listen()
+        return True
 
+    def _joinChannel(self):
+        """
+        identify with NickServ and join the channel; invoked from _listen()
+        when the welcome message 001 is received.
+        """
         if self._authtype == 'nickserv':
             if not self._sendMessage("PRIVMSG NickServ IDENTIFY %s"
                                      % self._password):
@@ -74,30 +113,47 @@ class IRCConnection(AbstractConnection.AbstractConnection):
         return True
 
     def _closeConnection(self):
-        self._sendMessage("QUIT")
-        self._socket.shutdown(socket.SHUT_RDWR)
+        self._sendMessage("QUIT", AbstractConnection.PRIORITY_URGENT)
+        self._drainSendQueue()
+        try:
+            self._socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            # e.g. the connection was never completed.
+            pass
         self._socket.close()
         return True
 
+    def _fileno(self):
+        return self._socket.fileno()
+
     def _listen(self):
         """
         reads a bunch of data from the socket, splits it up in lines,
         and interprets them.
-        the last line, if unfinished, is not interpreted and saved for the
-        next _listen() call.
+        the last line, if unfinished, is not interpreted and kept by the
+        line reader for the next _listen() call.
         """
 
         # read up to 4 kB of data into the buffer.
-        self._readBuffer += self._socket.recv(4096)
-        # get all distinct lines from the buffer into lines.
-        lines = self._readBuffer.split('\n')
-        # move the last (unfinished) line back into the buffer.
-        self._readBuffer = lines.pop()
+        try:
+            data = self._socket.recv(4096)
+        except Exception as e:
+            if util.would_block(e):
+                return True
+            raise
+        if not data:
+            # an orderly close; _onReadable() disconnects cleanly.
+            self._log("connection closed by server", 1)
+            self._connected = False
+            return True
+        # get all complete lines; overlong lines are discarded.
+        lines = self._lineReader.feed(data)
 
         # process all lines.
         for line in lines:
-            line = util.try_decode(line, self._encoding)
-            self._log("rx: " + line, 3)
+            self._countReceived('line', len(line))
+            line = self._decoder.decode(line)
+            self._log("rx: %s", 3, line)
             # split the line up at spaces
             line = line.rstrip().split(' ', 3)
 
@@ -106,7 +162,21 @@ class IRCConnection(AbstractConnection.AbstractConnection):
 
             # check if the line contains a ping message (PING)
             if line[0] == "PING":
-                self._sendMessage("PONG " + line[1])
+                self._sendMessage("PONG " + line[1],
+                                  AbstractConnection.PRIORITY_URGENT)
+
+            # answer to our own PING: ':server PONG server :token'
+            if line[1] == "PONG" and len(line) == 4:
+                rtt = self._pongReceived(line[3].lstrip(':'))
+                if rtt is not None:
+                    self._log("ping answer received, rtt %.1f ms", 3,
+                              rtt * 1000)
+
+            # learn our own hostmask from the echo of our JOIN
+            if line[1] == "JOIN":
+                source = line[0].lstrip(':')
+                if source.split('!')[0] == self._nickname:
+                    self._hostmask = source
 
             if len(line) < 4:
                 continue
@@ -121,26 +191,94 @@ class IRCConnection(AbstractConnection.AbstractConnection):
 
             elif line[1] == "001":
                 self.welcomemsg_received = True
+                self._joinChannel()
+                self._ping()
 
         return True
 
     def _sendMessageUnsafe(self, message):
         """
-        send the given line via the socket.
+        append the given line to the write buffer.
         """
-        self._log("tx: " + message, 3)
-        try:
-            self._socket.send(util.try_encode(message, self._encoding) + "\n")
-        except Exception as e:
-            self._log("failed sending %s: " % (message) + str(e), 1)
-            return False
+        self._log("tx: %s", 3, message)
+        data = util.try_encode(message, self._encoding) + "\n"
+        self._countSent('line', len(data))
+        self._writer.append(data)
         return True
 
+    def _flushUnsafe(self):
+        return self._writer.writeTo(self._socket)
+
     def _sendTextMessageUnsafe(self, message):
         """
         send a PRIVMSG to #self._channel
+
+        IRC lines are limited to 512 bytes, including the
+        ':nick!user@host ' prefix that the server adds when relaying them,
+        and the trailing CRLF. longer messages are split into several
+        PRIVMSGs.
+        """
+        command = "PRIVMSG #" + self._channel + " :"
+        if self._hostmask is not None:
+            prefixlen = len(util.try_encode(self._hostmask, self._encoding))
+        else:
+            # assume the maximum user (10) and host (63) name lengths.
+            prefixlen = len(self._nickname) + 1 + 10 + 1 + 63
+        budget = (512 - (1 + prefixlen + 1) -
+                  len(util.try_encode(command, self._encoding)) - 2)
+
+        for line in message.splitlines():
+            for piece in util.split_encoded(line, self._encoding, budget):
+                if not self._sendMessage(command + piece):
+                    return False
+        return True
+
+    def _ping(self):
+        """
+        sends a PING with the current time as token, to measure the
+        round-trip time, and re-schedules itself every 30 seconds;
+        the timer is cancelled when the connection is closed.
+        """
+        if not self._connected:
+            return
+        now = time.time()
+        token = "%.6f" % now
+        self._pingSent(token, now)
+        if not self._sendMessage("PING :" + token,
+                                 AbstractConnection.PRIORITY_URGENT):
+            self._log("failed to send ping message", 1)
+        self._callLater(30, self._ping)
+
+    def decodeStats(self):
+        """
+        returns a dict of statistics about the decoding of received lines,
+        see LineDecoder.stats().
+        """
+        return self._decoder.stats()
+
+    def _collectMetrics(self):
+        """
+        adds the decoding statistics (see decodeStats()) to the metrics of
+        AbstractConnection.
         """
-        return self._sendMessage("PRIVMSG #" + self._channel + " :" + message)
+        families = super(IRCConnection, self)._collectMetrics()
+        labels = {'connection': self._name}
+        stats = self.decodeStats()
+        families.extend([
+            ('sftbot_irc_lines_decoded_cached_total', 'counter',
+             "received lines decoded with the remembered codec of their "
+             "nick", [('', labels, stats['cached'])]),
+            ('sftbot_irc_lines_decoded_fallback_total', 'counter',
+             "received lines that needed another codec than the preferred "
+             "one", [('', labels, stats['fallback'])]),
+            ('sftbot_irc_decode_failures_total', 'counter',
+             "failed attempts to decode a received line",
+             [('', labels, stats['failed'])]),
+            ('sftbot_irc_decode_remembered_nicks', 'gauge',
+             "nicks whose codec is remembered",
+             [('', labels, stats['sources'])]),
+        ])
+        return families
 
     def setAway(self, message=None):
         """
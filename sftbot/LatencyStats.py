@@ -0,0 +1,87 @@
+import math
+import collections
+
+
+class LatencyStats(object):
+    """
+    round-trip time statistics of a connection's pings.
+
+    average and variance are computed over all samples, percentiles over
+    the last 'window' samples.
+    """
+
+    def __init__(self, window=100):
+        self._samples = collections.deque(maxlen=window)
+        self.count = 0
+        self.lost = 0
+        self.last = None
+        self._mean = 0.0
+        # sum of squared differences from the mean (Welford's algorithm)
+        self._m2 = 0.0
+
+    def add(self, rtt):
+        """
+        adds a measured round-trip time, in seconds.
+        """
+        self.count += 1
+        self.last = rtt
+        delta = rtt - self._mean
+        self._mean += delta / self.count
+        self._m2 += delta * (rtt - self._mean)
+        self._samples.append(rtt)
+
+    def addLost(self):
+        """
+        counts a ping that was never answered.
+        """
+        self.lost += 1
+
+    def average(self):
+        return self._mean
+
+    def variance(self):
+        if self.count < 2:
+            return 0.0
+        return self._m2 / (self.count - 1)
+
+    def percentile(self, p):
+        """
+        returns the p-th percentile (0 <= p <= 100) of the recent samples,
+        or None if there are none.
+        """
+        if not self._samples:
+            return None
+        samples = sorted(self._samples)
+        index = int(math.ceil(p / 100.0 * len(samples))) - 1
+        return samples[max(0, min(index, len(samples) - 1))]
+
+    def stats(self):
+        """
+        returns a dict with the numbers of answered and lost pings, and
+        the last, average, standard deviation, median, 90th and 99th
+        percentile round-trip times in seconds.
+        """
+        return {
+            'count': self.count,
+            'lost': self.lost,
+            'last': self.last,
+            'avg': self._mean,
+            'stddev': math.sqrt(self.variance()),
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+        }
+
+    def summary(self):
+        """
+        returns the stats as a single line of text.
+        """
+        if not self.count:
+            return "no ping answers yet (%d lost)" % self.lost
+        stats = self.stats()
+        return ("rtt %.1f ms (avg %.1f ms, sd %.1f ms, p50 %.1f ms, "
+                "p90 %.1f ms, p99 %.1f ms), %d answered, %d lost" %
+                (stats['last'] * 1000, stats['avg'] * 1000,
+                 stats['stddev'] * 1000, stats['p50'] * 1000,
+                 stats['p90'] * 1000, stats['p99'] * 1000,
+                 stats['count'], stats['lost']))
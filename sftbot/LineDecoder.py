@@ -0,0 +1,129 @@
+import re
+import codecs
+import collections
+
+# a UTF-8 lead byte followed by a continuation byte; text in a single-byte
+# encoding practically never contains this.
+_utf8sequence = re.compile(b'[\xc2-\xf4][\x80-\xbf]')
+
+_latin1 = codecs.lookup('latin-1').name
+
+
+class LineDecoder(object):
+    """
+    decodes received lines like util.try_decode(), but remembers which
+    codec worked for sources (e.g. IRC nicks) whose lines can't be decoded
+    with the preferred codec, and tries that one next for their following
+    lines.
+
+    the codecs are tried in the order: preferred codec, utf-8, latin-1.
+    since latin-1 can decode everything, a source remembered as latin-1
+    is still checked for UTF-8 first if the line looks like UTF-8.
+
+    the preferred codec is always tried first, so remembering a codec
+    only saves attempts for sources that use neither the preferred codec
+    nor the one after it.
+
+    sourceof(line) returns the source of a line, or None. it is only
+    called for lines that can't be decoded with the preferred codec, so
+    lines in the preferred codec cost no more than with util.try_decode().
+
+    at most maxsources sources are remembered.
+    """
+
+    def __init__(self, preferredcodec, maxsources=1024, sourceof=None):
+        # normalized codec names, in the order in which they are tried
+        self._codecs = []
+        for codec in (preferredcodec, 'utf-8', 'latin-1'):
+            codec = codecs.lookup(codec).name
+            if codec not in self._codecs:
+                self._codecs.append(codec)
+        self._preferred = self._codecs[0]
+        # if the preferred codec is utf-8, a line that reaches the cached
+        # codec is known not to be UTF-8.
+        self._checkUtf8 = self._preferred != 'utf-8'
+        self._maxSources = maxsources
+        if sourceof is None:
+            sourceof = _noSource
+        self._sourceOf = sourceof
+        # source -> codec other than the preferred one, oldest first
+        self._sources = collections.OrderedDict()
+        # nothing is counted for lines in the preferred codec, to keep
+        # that path as short as possible.
+        self._stats = {
+            # lines that were decoded with the remembered codec
+            'cached': 0,
+            # lines that needed another codec
+            'fallback': 0,
+            # decoding attempts that failed
+            'failed': 0,
+        }
+
+    def decode(self, line):
+        """
+        returns the decoded line; latin-1 is the last resort, so this
+        never fails.
+        """
+        # the common case. pure ASCII lines take this path, too: the
+        # decoders of ASCII-compatible codecs have a fast path for them,
+        # which is faster than checking beforehand.
+        try:
+            return line.decode(self._preferred)
+        except UnicodeError:
+            self._stats['failed'] += 1
+
+        source = self._sourceOf(line)
+        cached = self._sources.get(source)
+        if cached is None:
+            return self._decodeFallback(line, source, self._codecs[1:])
+
+        if (cached != _latin1 or not self._checkUtf8 or
+                not _utf8sequence.search(line)):
+            try:
+                text = line.decode(cached)
+            except UnicodeError:
+                self._stats['failed'] += 1
+            else:
+                self._stats['cached'] += 1
+                return text
+
+        # the source has switched its encoding.
+        return self._decodeFallback(line, source, self._codecs[1:])
+
+    def _decodeFallback(self, line, source, order):
+        for codec in order:
+            try:
+                text = line.decode(codec)
+            except UnicodeError:
+                self._stats['failed'] += 1
+                continue
+
+            if codec == self._preferred:
+                self._sources.pop(source, None)
+            else:
+                self._stats['fallback'] += 1
+                if source is not None:
+                    self._remember(source, codec)
+            return text
+
+    def _remember(self, source, codec):
+        if source in self._sources:
+            del self._sources[source]
+        elif len(self._sources) >= self._maxSources:
+            self._sources.popitem(last=False)
+        self._sources[source] = codec
+
+    def stats(self):
+        """
+        returns a dict with the numbers of lines that were decoded with
+        the remembered codec of their source, and with another codec than
+        the preferred one, the number of failed decoding attempts, and
+        the number of remembered sources.
+        """
+        stats = dict(self._stats)
+        stats['sources'] = len(self._sources)
+        return stats
+
+
+def _noSource(line):
+    return None
@@ -0,0 +1,63 @@
+class LineReader(object):
+    """
+    splits a byte stream into lines, terminated by '\n' or '\r\n'.
+
+    only newly received bytes are scanned for line terminators, and lines
+    that exceed maxlength bytes are discarded instead of being buffered
+    forever.
+    """
+
+    def __init__(self, maxlength=8192):
+        self._maxlength = maxlength
+        # the unfinished line
+        self._buffer = bytearray()
+        # True while the rest of an overlong line is being skipped
+        self._discarding = False
+        # number of discarded overlong lines
+        self.overlong = 0
+
+    def feed(self, data):
+        """
+        appends the received data, and returns a list of all lines that
+        are complete now, without their terminators.
+        """
+        buf = self._buffer
+        # the unfinished line contains no '\n', so scanning starts
+        # at the new data.
+        pos = len(buf)
+        buf.extend(data)
+        pos = buf.find(b'\n', pos)
+
+        lines = []
+        start = 0
+        while pos >= 0:
+            end = pos
+            if end > start and buf[end - 1] == 13:
+                end -= 1
+
+            if self._discarding:
+                # this was the tail of an overlong line.
+                self._discarding = False
+            elif end - start > self._maxlength:
+                self.overlong += 1
+            else:
+                lines.append(bytes(buf[start:end]))
+
+            start = pos + 1
+            pos = buf.find(b'\n', start)
+
+        del buf[:start]
+
+        # a trailing '\r' may be the start of the line's '\r\n'.
+        limit = self._maxlength
+        if buf and buf[-1] == 13:
+            limit += 1
+        if len(buf) > limit:
+            # the unfinished line is too long already; skip until the next
+            # line terminator.
+            if not self._discarding:
+                self.overlong += 1
+                self._discarding = True
+            del buf[:]
+
+        return lines
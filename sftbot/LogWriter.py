@@ -0,0 +1,82 @@
+import sys
+import Queue
+import threading
+
+
+class LogWriter(object):
+    """
+    writes lines to a stream from a background thread, so that the event
+    loop never blocks on a slow terminal or pipe.
+
+    if more than maxqueue lines are waiting, further lines are dropped
+    and counted.
+    """
+
+    def __init__(self, stream=None, maxqueue=10000):
+        if stream is None:
+            stream = sys.stdout
+        self._stream = stream
+        self._queue = Queue.Queue(maxqueue)
+        # number of lines that were dropped because the queue was full
+        self.dropped = 0
+        self._thread = threading.Thread(target=self._run, name="log writer")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self, line):
+        """
+        queues the line for writing; never blocks.
+        """
+        try:
+            self._queue.put_nowait(line)
+        except Queue.Full:
+            self.dropped += 1
+
+    def close(self, timeout=5):
+        """
+        waits until all queued lines are written, and stops the thread.
+        """
+        if not self._thread.is_alive():
+            return
+        self._queue.put(None)
+        self._thread.join(timeout)
+        if self.dropped:
+            self._writeLines(["log writer: %d lines were dropped" %
+                              self.dropped])
+
+    def _run(self):
+        while True:
+            # write everything that is waiting at once.
+            lines = [self._queue.get()]
+            try:
+                while len(lines) < 256:
+                    lines.append(self._queue.get_nowait())
+            except Queue.Empty:
+                pass
+
+            if None in lines:
+                self._writeLines(lines[:lines.index(None)])
+                return
+            self._writeLines(lines)
+
+    def _writeLines(self, lines):
+        try:
+            self._stream.write("\n".join(lines) + "\n")
+            self._stream.flush()
+        except:
+            # there is nowhere to report this to.
+            pass
+
+
+_defaultWriter = None
+
+
+def defaultWriter():
+    """
+    returns the process-wide log writer for stdout, creating it if
+    required.
+    """
+    global _defaultWriter
+    if _defaultWriter is None:
+        _defaultWriter = LogWriter()
+    return _defaultWriter
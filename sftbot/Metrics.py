@@ -0,0 +1,119 @@
+import bisect
+
+# default histogram buckets for latencies, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1, 2.5, 5, 10)
+
+
+class Histogram(object):
+    """
+    counts observed values in buckets, like a prometheus histogram.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self._buckets = tuple(sorted(buckets))
+        # one count per bucket, plus one for values above the last bucket
+        self._counts = [0] * (len(self._buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self._counts[bisect.bisect_left(self._buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, labels):
+        """
+        returns the (suffix, labels, value) samples of the histogram,
+        with cumulative bucket counts.
+        """
+        result = []
+        cumulative = 0
+        for bound, count in zip(self._buckets, self._counts):
+            cumulative += count
+            result.append(('_bucket', dict(labels, le=repr(float(bound))),
+                           cumulative))
+        result.append(('_bucket', dict(labels, le='+Inf'), self.count))
+        result.append(('_sum', labels, self.sum))
+        result.append(('_count', labels, self.count))
+        return result
+
+
+class Metrics(object):
+    """
+    registry of metric collectors, rendered in the prometheus text format.
+
+    a collector is a function that returns a list of metric families,
+    each a tuple (name, type, help, samples), where samples is a list of
+    (name suffix, labels dict, value) tuples. collectors are only called
+    when the metrics are rendered, so the counters themselves can be
+    plain attributes of the objects that update them.
+    """
+
+    def __init__(self):
+        self._collectors = []
+
+    def register(self, collector):
+        self._collectors.append(collector)
+
+    def unregister(self, collector):
+        self._collectors.remove(collector)
+
+    def render(self):
+        """
+        returns the current metrics as a prometheus text exposition.
+        """
+        # families with the same name (e.g. from several connections) are
+        # merged, keeping the order in which they first appeared.
+        families = {}
+        order = []
+        for collector in self._collectors:
+            for name, mtype, helptext, samples in collector():
+                if name not in families:
+                    families[name] = (mtype, helptext, [])
+                    order.append(name)
+                families[name][2].extend(samples)
+
+        lines = []
+        for name in order:
+            mtype, helptext, samples = families[name]
+            lines.append("# HELP %s %s" % (name, helptext))
+            lines.append("# TYPE %s %s" % (name, mtype))
+            for suffix, labels, value in samples:
+                lines.append("%s%s%s %s" % (name, suffix,
+                                            formatLabels(labels),
+                                            formatValue(value)))
+        return "\n".join(lines) + "\n"
+
+
+def formatLabels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('%s="%s"' % (key, escapeLabel(labels[key]))
+                          for key in sorted(labels)) + "}"
+
+
+def escapeLabel(value):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def formatValue(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+_defaultMetrics = None
+
+
+def defaultMetrics():
+    """
+    returns the process-wide metrics registry, creating it if required.
+    """
+    global _defaultMetrics
+    if _defaultMetrics is None:
+        _defaultMetrics = Metrics()
+    return _defaultMetrics
@@ -0,0 +1,147 @@
+import socket
+import util
+import EventLoop
+import LogWriter
+import WriteBuffer
+
+
+class MetricsServer(object):
+    """
+    minimal HTTP server that serves the rendered Metrics at /metrics,
+    for being scraped by prometheus.
+
+    it runs in the event loop like the connections: every request is read
+    and answered without blocking, and clients that don't send a complete
+    request within 10 seconds are dropped.
+    """
+
+    def __init__(self, metrics, address='127.0.0.1', port=9300, loop=None,
+                 logwriter=None):
+        self._metrics = metrics
+        self._address = address
+        self._port = port
+        if loop is None:
+            loop = EventLoop.defaultLoop()
+        self._loop = loop
+        if logwriter is None:
+            logwriter = LogWriter.defaultWriter()
+        self._logWriter = logwriter
+        self._socket = None
+        # client socket -> _Client
+        self._clients = {}
+
+    def start(self):
+        """
+        binds the listening socket; raises an exception if that fails.
+        """
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind((self._address, self._port))
+        self._socket.listen(16)
+        self._socket.setblocking(False)
+        self._loop.addReader(self._socket.fileno(), self._accept)
+        self._log("serving metrics at http://%s:%d/metrics" %
+                  (self._address, self._port))
+
+    def stop(self):
+        for client in list(self._clients.values()):
+            client.close()
+        if self._socket is not None:
+            self._loop.removeReader(self._socket.fileno())
+            self._socket.close()
+            self._socket = None
+
+    def _accept(self):
+        try:
+            sock, _ = self._socket.accept()
+        except Exception as e:
+            if util.would_block(e):
+                return
+            self._log("accept failed: %s" % e)
+            return
+        sock.setblocking(False)
+        self._clients[sock] = _Client(self, sock)
+
+    def _respond(self, request):
+        """
+        returns the HTTP response for the request head.
+        """
+        parts = request.split(b'\r\n', 1)[0].split(b' ')
+        if len(parts) < 2 or parts[0] != b'GET':
+            return _response(405, "method not allowed\n")
+        if parts[1].split(b'?', 1)[0] not in (b'/', b'/metrics'):
+            return _response(404, "not found\n")
+        return _response(200, self._metrics.render(),
+                         "text/plain; version=0.0.4")
+
+    def _log(self, message):
+        self._logWriter.write("(1) metrics:   " + message)
+
+
+class _Client(object):
+    """
+    one HTTP connection to the metrics server.
+    """
+
+    def __init__(self, server, sock):
+        self._server = server
+        self._socket = sock
+        self._fd = sock.fileno()
+        self._request = bytearray()
+        self._writer = None
+        loop = server._loop
+        loop.addReader(self._fd, self._onReadable)
+        self._timeout = loop.callLater(10, self.close)
+
+    def _onReadable(self):
+        try:
+            data = self._socket.recv(4096)
+        except Exception as e:
+            if util.would_block(e):
+                return
+            data = b''
+        if not data:
+            self.close()
+            return
+
+        self._request.extend(data)
+        if b'\r\n\r\n' not in self._request:
+            if len(self._request) > 8192:
+                self.close()
+            return
+
+        self._server._loop.removeReader(self._fd)
+        self._writer = WriteBuffer.WriteBuffer(4096)
+        self._writer.append(self._server._respond(bytes(self._request)))
+        self._onWritable()
+
+    def _onWritable(self):
+        try:
+            done = self._writer.writeTo(self._socket)
+        except Exception:
+            done = True
+        if done:
+            self.close()
+        else:
+            self._server._loop.addWriter(self._fd, self._onWritable)
+
+    def close(self):
+        if self._socket is None:
+            return
+        loop = self._server._loop
+        loop.removeReader(self._fd)
+        loop.removeWriter(self._fd)
+        self._timeout.cancel()
+        self._server._clients.pop(self._socket, None)
+        self._socket.close()
+        self._socket = None
+
+
+def _response(status, body, contenttype="text/plain"):
+    reasons = {200: "OK", 404: "Not Found", 405: "Method Not Allowed"}
+    return ("HTTP/1.0 %d %s\r\n"
+            "Content-Type: %s\r\n"
+            "Content-Length: %d\r\n"
+            "Connection: close\r\n"
+            "\r\n" % (status, reasons[status], contenttype, len(body)) +
+            body)
@@ -1,12 +1,14 @@
 import AbstractConnection
+import os
 import sys
 import socket
 import string
 import time
 import ssl
 import platform
-import struct
-import thread
+import util
+import MumbleFraming
+import MumbleState
 import sftbot.protobuf.Mumble_pb2 as pb2
 
 messageTypes = {
@@ -26,67 +28,212 @@ messageTypes = {
     13: pb2.ACL,
     14: pb2.QueryUsers,
     15: pb2.CryptSetup,
+    16: pb2.ContextActionModify,
+    17: pb2.ContextAction,
+    18: pb2.UserList,
+    19: pb2.VoiceTarget,
+    20: pb2.PermissionQuery,
+    21: pb2.CodecVersion,
+    22: pb2.UserStats,
+    23: pb2.RequestBlob,
+    24: pb2.ServerConfig,
+    25: pb2.SuggestConfig,
 }
 
 for k, v in messageTypes.items():
     v.typeID = k
 
+# type id -> message type name, for logs and metrics
+typeNames = dict((k, v.__name__) for k, v in messageTypes.items())
+
+
+def parseMessage(messagetype, data):
+    """
+    returns a new messagetype instance parsed from data (a buffer), or
+    None if the data is invalid.
+    """
+    pbMess = messagetype()
+    try:
+        pbMess.ParseFromString(data.tobytes())
+    except:
+        return None
+    return pbMess
+
+
+class LazyMessage(object):
+    """
+    a received message that is only parsed when somebody asks for it.
+
+    the raw data is a view into the read buffer, so it may only be used
+    while the message is being dispatched.
+    """
+
+    def __init__(self, messagetype, data):
+        self.messagetype = messagetype
+        self.data = data
+        self._parsed = None
+        # True if a handler keeps the raw data for parsing it later
+        self.deferred = False
+
+    def parse(self):
+        """
+        returns the parsed pb2 message, or None if the data is invalid.
+        """
+        if self._parsed is None:
+            self._parsed = parseMessage(self.messagetype, self.data)
+        return self._parsed
+
+    def defer(self):
+        """
+        returns a copy of the raw data, for parsing it later (e.g. in
+        bulk); whoever does that should count the parse.
+        """
+        self.deferred = True
+        return self.data.tobytes()
+
+    def isParsed(self):
+        return self._parsed is not None
+
 
 class MumbleConnection(AbstractConnection.AbstractConnection):
 
     # call the superconstructor and set global configuration variables.
     def __init__(self, hostname, port, nickname, channel, password, name,
-                 loglevel):
-        super(MumbleConnection, self).__init__(name, loglevel)
+                 loglevel, deaf=False, statefile=None, sslcontext=None,
+                 maxusers=100000, maxchannels=10000, **kwargs):
+        super(MumbleConnection, self).__init__(name, loglevel, **kwargs)
         self._hostname = hostname
         self._port = port
         self._nickname = nickname
         self._channel = channel
         self._password = password
-
-        # channel id lookup table
-        self._channelIds = {}
-        # user id lookup table (and reverse)
-        self._users = {}
-        self._userIds = {}
+        # if True, the bot deafens itself, so murmur stops sending us voice
+        self._deaf = deaf
+        # ssl.SSLContext for the connection, which may be shared with other
+        # connections; if None, ssl.wrap_socket() is used.
+        self._sslContext = sslcontext
+
+        # users and channels on the server; updates for further ones than
+        # maxusers/maxchannels are dropped.
+        self._state = MumbleState.ServerState(maxusers, maxchannels)
+        # the state is saved here, and loaded from here at startup, so
+        # names can be resolved before the initial sync has finished.
+        self._stateFile = statefile
+        if statefile is not None:
+            self._loadState()
+
+        # until ServerSync arrives, the raw ChannelState and UserState
+        # messages are collected here, and merged into the state in bulk.
+        self._syncing = False
+        self._syncChannels = []
+        self._syncUsers = []
+        # ids of all channels and users that were part of the sync
+        self._syncChannelIds = set()
+        self._syncSessions = set()
+        # timestamps and durations of the sync phase
+        self._syncTimes = {}
+        self._syncBatchStarted = None
         # current session and channel id
         self._session = None
 
+        # message handler lists, indexed by message type id;
+        # entries are (function, lazy) tuples.
+        self._handlers = [[] for _ in range(max(messageTypes) + 1)]
+        # whether any of the handlers is lazy, by type id
+        self._lazyTypes = [False] * len(self._handlers)
+        # number of received messages that were parsed, and that were
+        # dropped unparsed, by type id
+        self._parsedMessages = [0] * len(self._handlers)
+        self._skippedMessages = [0] * len(self._handlers)
+        # number of received messages with unknown type id
+        self._unknownMessages = 0
+        # number and total size of the messages that the frame readers
+        # dropped without buffering them (voice packets)
+        self._skippedFrames = 0
+        self._skippedBytes = 0
+
+        self.registerHandler(pb2.ServerSync, self._onServerSync)
+        self.registerHandler(pb2.ChannelState, self._onChannelState,
+                             lazy=True)
+        self.registerHandler(pb2.ChannelRemove, self._onChannelRemove)
+        self.registerHandler(pb2.TextMessage, self._onTextMessage)
+        self.registerHandler(pb2.UserState, self._onUserState, lazy=True)
+        self.registerHandler(pb2.UserRemove, self._onUserRemove)
+        self.registerHandler(pb2.Ping, self._onPing)
+
         self._socket = None
+        # is the TLS handshake in progress?
+        self._handshaking = False
+        # without SSLContext: has the default protocol failed, so TLSv1 is
+        # used instead?
+        self._legacyTLSv1 = False
         # contains all received, but uninterpreted data.
-        self._readBuffer = ""
+        self._reader = None
+        # contains all sent, but not yet written data.
+        self._writer = None
 
     def _openConnection(self):
         """
-        open the (SSL) socket and return True.
+        starts connecting; the TLS handshake is done by _finishOpening().
         # TODO: support server certificate validation, provide client cert
         """
-        try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.connect((self._hostname, self._port))
-            self._log("trying python default ssl socket", 3)
-            self._socket = ssl.wrap_socket(s)
-            return True
-        except ssl.SSLError:
-            try:
-                s.close()
-            except:
-                pass
+        self._legacyTLSv1 = False
+        return self._startConnect()
+
+    def _startConnect(self):
+        self._socket = util.start_connect(self._hostname, self._port)
+        self._handshaking = False
+        return 'write'
+
+    def _finishOpening(self):
+        """
+        completes the TCP connection, and performs the TLS handshake on
+        the non-blocking socket.
+        """
+        if not self._handshaking:
+            util.finish_connect(self._socket)
+            if self._sslContext is not None:
+                self._socket = self._sslContext.wrap_socket(
+                    self._socket, do_handshake_on_connect=False)
+            elif self._legacyTLSv1:
+                self._socket = ssl.wrap_socket(
+                    self._socket, ssl_version=ssl.PROTOCOL_TLSv1,
+                    do_handshake_on_connect=False)
+            else:
+                self._log("trying python default ssl socket", 3)
+                self._socket = ssl.wrap_socket(
+                    self._socket, do_handshake_on_connect=False)
+            self._handshaking = True
 
         try:
-            self._log("python default ssl connection failed, trying TLSv1", 2)
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.connect((self._hostname, self._port))
-            self._socket = ssl.wrap_socket(s, ssl_version=ssl.PROTOCOL_TLSv1)
-            return True
+            return util.ssl_handshake(self._socket)
         except ssl.SSLError:
+            if self._sslContext is not None:
+                raise
             try:
-                s.close()
+                self._socket.close()
             except:
                 pass
-            raise Exception("Error setting up the SSL/TLS socket to murmur.")
+            if self._legacyTLSv1:
+                raise Exception("Error setting up the SSL/TLS socket to "
+                                "murmur.")
+            self._log("python default ssl connection failed, trying TLSv1",
+                      2)
+            self._legacyTLSv1 = True
+            return self._startConnect()
 
     def _initConnection(self):
+        self._syncing = True
+        self._syncChannels = []
+        self._syncUsers = []
+        self._syncChannelIds = set()
+        self._syncSessions = set()
+        self._syncTimes = {'start': time.time(), 'processing': 0.0}
+        # fresh read buffer for the new stream.
+        # we don't analyze voice, so voice packets are dropped right away.
+        self._reader = MumbleFraming.FrameReader(
+            skiptypes=[pb2.UDPTunnel.typeID])
+        self._writer = MumbleFraming.FrameWriter()
         # send version package.
         pbMess = pb2.Version()
         pbMess.release = "1.2.6"
@@ -108,108 +255,443 @@ class MumbleConnection(AbstractConnection.AbstractConnection):
 
     def _postConnect(self):
         """
-        start ping loop; connection is _not_ established yet.
+        start ping timer; connection is _not_ established yet.
         """
-        thread.start_new_thread(self._pingLoop, ())
+        self._ping()
         return True
 
     def _closeConnection(self):
         self._channelId = None
         self._session = None
-        self._socket.shutdown(socket.SHUT_RDWR)
+        # the state is kept as a starting point for the next connection;
+        # it will be reconciled during the next sync.
+        self._syncing = False
+        # the collected states of an unfinished sync are never parsed.
+        self._skippedMessages[pb2.ChannelState.typeID] += len(
+            self._syncChannels)
+        self._skippedMessages[pb2.UserState.typeID] += len(self._syncUsers)
+        self._syncChannels = []
+        self._syncUsers = []
+        self.saveState()
+        # try to get rid of the last messages (e.g. a goodbye message).
+        self._drainSendQueue()
+        try:
+            self._socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            # e.g. the connection was never completed.
+            pass
         self._socket.close()
         return True
 
+    def _fileno(self):
+        return self._socket.fileno()
+
     def _listen(self):
         """
-        read and interpret data from socket.
+        read all data that is available on the socket, and interpret all
+        complete messages in it.
+
+        the SSL layer may already have buffered more data than select()
+        knows about, so keep reading until its buffer is empty.
         """
-        header = self._socket.recv(6)
-        if len(header) == 6:
-            (mid, size) = struct.unpack(">HI", header)
-        else:
-            raise Exception("expected 6 bytes, but got " + str(len(header)))
+        while True:
+            count = self._reader.readFrom(self._socket)
+            if count is None:
+                return True
+            if count == 0:
+                # an orderly close; _onReadable() disconnects cleanly.
+                self._log("connection closed by server", 1)
+                self._connected = False
+                return True
+            if self._syncing:
+                self._syncBatchStarted = time.time()
+                self._syncTimes.setdefault('first', self._syncBatchStarted)
+            frames = self._reader.frames()
+            self._countSkippedFrames()
+            for mid, data in frames:
+                if not self._handleMessage(mid, data):
+                    return False
+            if self._syncing:
+                self._syncTimes['processing'] += (time.time() -
+                                                  self._syncBatchStarted)
+            if not (self._connected and self._socket.pending()):
+                return True
+
+    def _countSkippedFrames(self):
+        """
+        counts the messages that the frame reader dropped since the last
+        call; they are voice packets.
+        """
+        frames, size = self._reader.takeSkipped()
+        if frames:
+            self._skippedFrames += frames
+            self._skippedBytes += size
+            self._countReceived(pb2.UDPTunnel.__name__, size, frames)
 
-        data = bytearray()
-        while len(data) < size:
-            data.extend(self._socket.recv(size - len(data)))
+    def _handleMessage(self, mid, data):
+        """
+        pass one message to all handlers for its type; it is only parsed
+        if one of them needs it.
 
-        # look up the message type and invoke the message type's constructor.
+        data is a memoryview that is only valid during this call.
+        """
+        typename = typeNames.get(mid, mid)
+        self._countReceived(typename, len(data))
+        if self._logEnabled(3):
+            self._log("rx", 3, type=typename, size=len(data))
         try:
-            messagetype = messageTypes[mid]
-            pbMess = messagetype()
-        except:
-            self._log("unknown package id: " + str(mid), 1)
+            handlers = self._handlers[mid]
+        except IndexError:
+            self._unknownMessages += 1
+            return True
+
+        if not handlers:
+            self._skippedMessages[mid] += 1
+            return True
+
+        if not self._lazyTypes[mid]:
+            # all handlers need the parsed message anyway.
+            pbMess = parseMessage(messageTypes[mid], data)
+            if pbMess is None:
+                self._log("message could not be parsed corerctly", 1,
+                          type=typename, size=len(data))
+                return True
+            self._parsedMessages[mid] += 1
+            for function, _ in handlers:
+                function(pbMess)
             return True
 
-        # parse the message.
-        if messagetype != pb2.UDPTunnel:
+        message = LazyMessage(messageTypes[mid], data)
+        for function, lazy in handlers:
+            if lazy:
+                function(message)
+                continue
+
+            pbMess = self._parse(message)
+            if pbMess is None:
+                break
+            function(pbMess)
+
+        if message.isParsed():
+            self._parsedMessages[mid] += 1
+        elif not message.deferred:
+            self._skippedMessages[mid] += 1
+        return True
+
+    def _parse(self, message):
+        """
+        returns the parsed LazyMessage, or None if it's invalid.
+        """
+        pbMess = message.parse()
+        if pbMess is None:
+            self._log("message could not be parsed corerctly", 1,
+                      type=message.messagetype.__name__,
+                      size=len(message.data))
+        return pbMess
+
+    def registerHandler(self, messagetype, function, lazy=False):
+        """
+        registers function as handler for the given pb2 message type;
+        it is invoked for each received message of that type.
+
+        the function is called with the parsed pb2 message; if lazy is
+        True, it is called with a LazyMessage instead, and the message is
+        only parsed if the function calls its parse() method.
+        """
+        self._handlers[messagetype.typeID].append((function, lazy))
+        if lazy:
+            self._lazyTypes[messagetype.typeID] = True
+
+    def channelPath(self, channelId):
+        """
+        returns the full path of the channel with the given id
+        (e.g. 'Root/Games/Lobby'), or None if it's unknown.
+        """
+        channel = self._state.channels.get(channelId)
+        if channel is None:
+            return None
+        return channel.path
+
+    def stateStats(self):
+        """
+        returns a dict with the numbers and memory usage of the known
+        users and channels, and the number of dropped updates.
+        """
+        return self._state.stats()
+
+    def messageStats(self):
+        """
+        returns a dict of the numbers of received messages that were
+        parsed (right away, or in bulk at the end of the sync), and that
+        were skipped without parsing, by message type name, plus the number
+        of messages with unknown type ids as 'unknown'.
+        """
+        stats = {'unknown': self._unknownMessages}
+        for mid, messagetype in messageTypes.items():
+            parsed = self._parsedMessages[mid]
+            skipped = self._skippedMessages[mid]
+            if parsed or skipped:
+                stats[messagetype.__name__] = {
+                    'parsed': parsed,
+                    'skipped': skipped,
+                }
+        return stats
+
+    def _collectMetrics(self):
+        """
+        adds the parsed and skipped message counts (see messageStats()) and
+        the server state statistics (see stateStats()) to the metrics of
+        AbstractConnection.
+        """
+        families = super(MumbleConnection, self)._collectMetrics()
+        labels = {'connection': self._name}
+        state = self.stateStats()
+        stats = self.messageStats()
+        unknown = stats.pop('unknown')
+
+        def byType(key):
+            return [('', dict(labels, type=name), entry[key])
+                    for name, entry in sorted(stats.items())]
+
+        families.extend([
+            ('sftbot_mumble_messages_parsed_total', 'counter',
+             "received mumble messages that were parsed", byType('parsed')),
+            ('sftbot_mumble_messages_skipped_total', 'counter',
+             "received mumble messages that were dropped without parsing",
+             byType('skipped')),
+            ('sftbot_mumble_messages_unknown_total', 'counter',
+             "received mumble messages with unknown type ids",
+             [('', labels, unknown)]),
+            ('sftbot_mumble_frames_skipped_total', 'counter',
+             "received voice packets that were dropped without buffering",
+             [('', labels, self._skippedFrames)]),
+            ('sftbot_mumble_frame_bytes_skipped_total', 'counter',
+             "size of the dropped voice packets",
+             [('', labels, self._skippedBytes)]),
+            ('sftbot_mumble_users', 'gauge',
+             "known users on the server", [('', labels, state['users'])]),
+            ('sftbot_mumble_channels', 'gauge',
+             "known channels on the server",
+             [('', labels, state['channels'])]),
+            ('sftbot_mumble_state_bytes', 'gauge',
+             "estimated memory used by the known users and channels",
+             [('', labels, state['bytes'])]),
+            ('sftbot_mumble_state_overflows_total', 'counter',
+             "dropped updates for users or channels beyond the limits",
+             [('', labels, state['overflows'])]),
+        ])
+        return families
+
+    def _onServerSync(self, pbMess):
+        self._log("server sync package received", 1,
+                  session=pbMess.session)
+        self._session = pbMess.session
+        if self._syncing:
+            self._finishSync()
+        self._joinChannel(self._channel)
+
+    def _finishSync(self):
+        """
+        merges the collected initial channel and user states in bulk,
+        and logs how long the sync phase took.
+        """
+        self._syncing = False
+        times = self._syncTimes
+        started = time.time()
+        times['processing'] += started - self._syncBatchStarted
+        self._applySyncStates()
+        # drop what we knew from before, but the server doesn't anymore.
+        stale = self._state.reconcile(self._syncChannelIds,
+                                      self._syncSessions)
+        now = time.time()
+
+        times['populate'] = now - started
+        times['total'] = now - times['start']
+        times['handshake'] = times.get('first', now) - times['start']
+        times['transfer'] = started - times.get('first', started)
+        times['channels'] = len(self._state.channels)
+        times['users'] = len(self._state.users)
+        times['stalechannels'], times['staleusers'] = stale
+        self._syncChannelIds = set()
+        self._syncSessions = set()
+
+        self._log("synced %d channels and %d users in %.3fs "
+                  "(handshake %.3fs, transfer %.3fs, of which processing "
+                  "%.3fs, populating state %.3fs)", 1,
+                  times['channels'], times['users'], times['total'],
+                  times['handshake'], times['transfer'],
+                  times['processing'], times['populate'])
+        if stale != (0, 0):
+            self._log("removed %d stale channels and %d stale users", 2,
+                      *stale)
+        self.saveState()
+
+    def _applySyncStates(self):
+        """
+        parses the collected raw ChannelState and UserState messages,
+        reusing one message instance for each type, and merges them into
+        the state.
+        """
+        invalid = 0
+
+        self._parsedMessages[pb2.ChannelState.typeID] += len(
+            self._syncChannels)
+        self._parsedMessages[pb2.UserState.typeID] += len(self._syncUsers)
+
+        # ParseFromString() replaces the previous content.
+        pbMess = pb2.ChannelState()
+        for data in self._syncChannels:
             try:
                 pbMess.ParseFromString(data)
             except:
-                self._log("message could not be parsed corerctly, type: " +
-                          messagetype.__name__, 1)
-                return True
+                invalid += 1
+                continue
+            self._syncChannelIds.add(pbMess.channel_id)
+            self._state.updateChannel(pbMess, False)
+        self._state.rebuildPaths()
+        self._syncChannels = []
 
-        # handle the message.
-        if messagetype == pb2.ServerSync:
-            self._log("server sync package received. session=" +
-                      str(pbMess.session), 1)
-            self._session = pbMess.session
-            self._joinChannel(self._channel)
-        elif messagetype == pb2.ChannelState:
-            self._log("channel state package received", 2)
-            if(pbMess.name):
-                self._log("channel " + pbMess.name + " has id " +
-                          str(pbMess.channel_id), 2)
-                self._channelIds[pbMess.name] = pbMess.channel_id
-        elif messagetype == pb2.TextMessage:
+        pbMess = pb2.UserState()
+        for data in self._syncUsers:
             try:
-                sender = self._users[pbMess.actor]
+                pbMess.ParseFromString(data)
             except:
-                sender = "unknown"
-                self._log("unknown text message sender id: " +
-                          str(pbMess.actor), 3)
-            self._log("text message received, sender: " + sender, 2)
-            self._invokeTextCallback(sender, pbMess.message)
-        elif messagetype == pb2.UserState:
-            self._log("user state package received.", 2)
-            if(pbMess.name and pbMess.session):
-                self._users[pbMess.session] = pbMess.name
-                self._userIds[pbMess.name] = pbMess.session
-                self._log("user " + pbMess.name + " has id " +
-                          str(pbMess.session), 2)
-
-            if ((pbMess.channel_id is not None and
-                 pbMess.session == self._session)):
-
-                self._channelId = pbMess.channel_id
-                self._log("I was dragged into another channel. Channel id:" +
-                          str(pbMess.channel_id), 2)
-
-                self._connectionEstablished()
-
-        elif messagetype == pb2.UDPTunnel:
-            self._log("won't analyze your voice packages, sorry", 4)
-        elif messagetype == pb2.Ping:
-            self._log("ping answer received", 3)
+                invalid += 1
+                continue
+            self._syncSessions.add(pbMess.session)
+            self._state.updateUser(pbMess)
+        self._syncUsers = []
+
+        if invalid:
+            self._log("%d state messages could not be parsed", 1, invalid)
+
+    def _loadState(self):
+        """
+        loads the state snapshot, if there is one.
+        """
+        if not os.path.isfile(self._stateFile):
+            return
+        try:
+            self._state.load(self._stateFile)
+        except:
+            self._logException("could not load state snapshot", 1)
+            self._state.clear()
         else:
-            self._log("unhandeled package received: " + messagetype.__name__ +
-                      ", " + str(size) + " bytes", 2)
-        return True
+            self._log("loaded %d channels and %d users from %s", 2,
+                      len(self._state.channels), len(self._state.users),
+                      self._stateFile)
+
+    def saveState(self):
+        """
+        saves a snapshot of the known channels and users, if a state file
+        was configured.
+        """
+        if self._stateFile is None or not self._state.channels:
+            return
+        try:
+            self._state.save(self._stateFile)
+        except:
+            self._logException("could not save state snapshot", 1)
+
+    def syncStats(self):
+        """
+        returns a dict with the timing breakdown of the last sync phase
+        (in seconds), and the numbers of synced channels and users.
+        """
+        return dict(self._syncTimes)
+
+    def _onChannelState(self, message):
+        if self._syncing:
+            self._syncChannels.append(message.defer())
+            return
+        pbMess = self._parse(message)
+        if pbMess is None:
+            return
+        self._log("channel state package received", 2)
+        channel = self._state.updateChannel(pbMess)
+        if channel is not None and pbMess.HasField('name'):
+            self._log("channel %s has id %d", 2, channel.name,
+                      channel.channelId)
+
+    def _onChannelRemove(self, pbMess):
+        if self._syncing:
+            # apply the collected states first, so they don't resurrect
+            # the channel later.
+            self._applySyncStates()
+        channel = self._state.removeChannel(pbMess.channel_id)
+        if channel is not None:
+            self._log("channel %s was removed", 2, channel.name)
+
+    def _onTextMessage(self, pbMess):
+        user = self._state.users.get(pbMess.actor)
+        if user is not None and user.name is not None:
+            sender = user.name
+        else:
+            sender = "unknown"
+            self._log("unknown text message sender id: %d", 3, pbMess.actor)
+        self._log("text message received, sender: %s", 2, sender)
+        self._invokeTextCallback(sender, pbMess.message)
+
+    def _onUserState(self, message):
+        if self._syncing:
+            self._syncUsers.append(message.defer())
+            return
+        pbMess = self._parse(message)
+        if pbMess is None:
+            return
+        self._log("user state package received.", 2)
+        user = self._state.updateUser(pbMess)
+        if user is not None and pbMess.HasField('name'):
+            self._log("user %s has id %d", 2, user.name, user.session)
+
+        if user is not None and pbMess.session == self._session:
+            if pbMess.HasField('channel_id'):
+                self._log("I was dragged into another channel. "
+                          "Channel id: %d", 2, pbMess.channel_id)
+            self._channelId = user.channelId
+
+            self._connectionEstablished()
+
+    def _onUserRemove(self, pbMess):
+        if self._syncing:
+            self._applySyncStates()
+        user = self._state.removeUser(pbMess.session)
+        if user is not None:
+            self._log("user %s has left", 2, user.name)
+
+    def _onPing(self, pbMess):
+        # the server echoes our timestamp.
+        rtt = None
+        if pbMess.HasField('timestamp'):
+            rtt = self._pongReceived(pbMess.timestamp)
+        if rtt is not None:
+            self._log("ping answer received, rtt %.1f ms", 3, rtt * 1000)
+        else:
+            self._log("ping answer received", 3)
 
     def _sendMessageUnsafe(self, message):
-        stringMessage = message.SerializeToString()
-        length = len(stringMessage)
-        header = struct.pack(">HI", message.typeID, length)
-        packedMessage = header + stringMessage
-        while len(packedMessage) > 0:
-            sent = self._socket.send(packedMessage)
-            if sent < 0:
-                raise Exception("could not send message")
-            packedMessage = packedMessage[sent:]
+        """
+        serialize the message into the write buffer.
+        message is either a pb2 message, or an already serialized
+        (type id, payload) tuple.
+
+        all messages that are queued in one event loop iteration share
+        one socket write.
+        """
+        if isinstance(message, tuple):
+            mid, payload = message
+        else:
+            mid, payload = message.typeID, message.SerializeToString()
+        typename = typeNames.get(mid, mid)
+        self._countSent(typename, len(payload))
+        if self._logEnabled(3):
+            self._log("tx", 3, type=typename, size=len(payload))
+        self._writer.appendFrame(mid, payload)
         return True
 
+    def _flushUnsafe(self):
+        return self._writer.writeTo(self._socket)
+
     def _sendTextMessageUnsafe(self, message):
         """
         send message as a TextMessage.
@@ -218,35 +700,59 @@ class MumbleConnection(AbstractConnection.AbstractConnection):
         pbMess.session.append(self._session)
         pbMess.channel_id.append(self._channelId)
         pbMess.message = message
-        self._log("sending text message: " + message, 2)
-        return self._sendMessage(pbMess)
+        self._log("sending text message: %s", 2, message)
+        return self._sendMessage((pb2.TextMessage.typeID,
+                                  pbMess.SerializeToString()))
 
-    def _pingLoop(self):
-        while self._connected:
-            pbMess = pb2.Ping()
-            if not self._sendMessage(pbMess):
-                self._log("failed to send ping message", 1)
-            time.sleep(10)
+    def _ping(self):
+        """
+        sends a ping message, and re-schedules itself every 10 seconds;
+        the timer is cancelled when the connection is closed.
+        """
+        if not self._connected:
+            return
+
+        now = time.time()
+        timestamp = int(now * 1000000)
+        pbMess = pb2.Ping()
+        pbMess.timestamp = timestamp
+        # report our view of the connection quality, like the mumble
+        # client does (in ms). good/late/lost are about the UDP voice
+        # channel, which we don't use.
+        pbMess.tcp_packets = self._latency.count
+        pbMess.tcp_ping_avg = self._latency.average() * 1000
+        pbMess.tcp_ping_var = self._latency.variance() * 1000000
+
+        self._pingSent(timestamp, now)
+        # pings bypass the queue, so the queueing delay doesn't distort
+        # the round-trip time.
+        if not self._sendMessage((pb2.Ping.typeID, pbMess.SerializeToString()),
+                                 AbstractConnection.PRIORITY_URGENT):
+            self._log("failed to send ping message", 1)
+        self._callLater(10, self._ping)
 
     def _joinChannel(self, channel):
         """
-        join a channel by name
+        join a channel by path ('Root/Games/Lobby' or 'Games/Lobby') or name
         """
         if not self._session:
             self._log("can't join channel: no valid session id", 1)
             return False
 
-        try:
-            cid = self._channelIds[channel]
-        except:
-            self._log("can't join channel " + channel + ": unknown id.", 1)
+        found = self._state.findChannel(channel)
+        if found is None:
+            self._log("can't join channel %s: unknown id.", 1, channel)
             return False
-        self._log("sending package to join channel " + channel +
-                  " (id " + str(cid) + ")", 2)
+        cid = found.channelId
+        self._log("sending package to join channel %s (id %d)", 2,
+                  channel, cid)
 
         pbMess = pb2.UserState()
         pbMess.session = self._session
         pbMess.channel_id = cid
+        if self._deaf:
+            pbMess.self_deaf = True
+            pbMess.self_mute = True
         if not self._sendMessage(pbMess):
             self._log("failed to send join package", 1)
             return False
@@ -259,13 +765,13 @@ class MumbleConnection(AbstractConnection.AbstractConnection):
         set user comment
         """
         if not self._session:
-            self._log("can't set comment to %s: no valid session id"
-                      % message, 1)
+            self._log("can't set comment to %s: no valid session id", 1,
+                      message)
             return False
 
         if not self._established:
-            self._log("can't set comment to %s: connection not established"
-                      % message, 1)
+            self._log("can't set comment to %s: connection not established",
+                      1, message)
             return False
 
         if len(message) > 128:
@@ -0,0 +1,152 @@
+import struct
+import WriteBuffer
+import util
+
+# every mumble TCP message starts with a 2-byte type id and a 4-byte length.
+header = struct.Struct(">HI")
+
+# murmur refuses messages larger than this; anything bigger means that the
+# stream is corrupt.
+MAX_MESSAGE_SIZE = 8 * 1024 * 1024
+
+
+class FrameReader(object):
+    """
+    reads mumble messages from a socket into one reusable buffer, and slices
+    out complete messages without copying them.
+
+    the memoryviews returned by frames() stay valid until the next call of
+    readFrom().
+
+    messages whose type id is in skiptypes are dropped without being
+    buffered.
+    """
+
+    def __init__(self, size=65536, skiptypes=()):
+        self._skipTypes = frozenset(skiptypes)
+        # number of bytes of the current skipped message that are still
+        # to be received
+        self._skipRemaining = 0
+        # statistics about skipped messages since the last takeSkipped()
+        self.skippedFrames = 0
+        self.skippedBytes = 0
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+        # start of the first unconsumed byte
+        self._start = 0
+        # end of the received data
+        self._end = 0
+        # size of the message at self._start, if its header is complete
+        self._needed = header.size
+
+    def takeSkipped(self):
+        """
+        returns the number of skipped messages and their total size as
+        (frames, bytes), and resets both.
+        """
+        result = (self.skippedFrames, self.skippedBytes)
+        self.skippedFrames = self.skippedBytes = 0
+        return result
+
+    def readFrom(self, sock):
+        """
+        reads as much data as fits into the buffer from sock.recv_into().
+
+        returns the number of read bytes; 0 means that the peer has closed
+        the connection, None that no data is available right now.
+        """
+        self._makeRoom()
+        try:
+            count = sock.recv_into(self._view[self._end:])
+        except Exception as e:
+            if util.would_block(e):
+                return None
+            raise
+        self._end += count
+        return count
+
+    def frames(self):
+        """
+        returns a list of (message type id, memoryview of message data)
+        for all complete messages in the buffer.
+        """
+        result = []
+        start, end = self._start, self._end
+
+        if self._skipRemaining:
+            # drop the received part of the skipped message.
+            count = min(self._skipRemaining, end - start)
+            self._skipRemaining -= count
+            start += count
+
+        while end - start >= header.size:
+            mid, size = header.unpack_from(self._buffer, start)
+            frameEnd = start + header.size + size
+            if mid in self._skipTypes:
+                self.skippedFrames += 1
+                self.skippedBytes += size
+                if frameEnd > end:
+                    # drop the rest as it arrives.
+                    self._skipRemaining = frameEnd - end
+                    self._needed = header.size
+                    start = end
+                    break
+                start = frameEnd
+                continue
+            if size > MAX_MESSAGE_SIZE:
+                raise Exception("message too large: " + str(size) + " bytes")
+            if frameEnd > end:
+                self._needed = header.size + size
+                break
+            result.append((mid, self._view[start + header.size:frameEnd]))
+            start = frameEnd
+        else:
+            self._needed = header.size
+
+        self._start = start
+        if start == end:
+            # everything was consumed; start over at the beginning.
+            self._start = self._end = 0
+        return result
+
+    def _makeRoom(self):
+        """
+        ensures that the buffer has free space at its end, and that the
+        incomplete message at its start fits into it.
+        """
+        if self._end < len(self._buffer) and (
+                self._start + self._needed <= len(self._buffer)):
+            return
+
+        pending = self._end - self._start
+        if self._needed > len(self._buffer):
+            # the incomplete message is larger than the buffer; replace it
+            # by a larger one. views into the old buffer remain valid.
+            size = len(self._buffer)
+            while size < self._needed:
+                size *= 2
+            buf = bytearray(size)
+            buf[:pending] = self._buffer[self._start:self._end]
+            self._buffer = buf
+            self._view = memoryview(buf)
+        else:
+            # move the incomplete message to the start of the buffer.
+            self._buffer[:pending] = self._buffer[self._start:self._end]
+        self._start = 0
+        self._end = pending
+
+
+class FrameWriter(WriteBuffer.WriteBuffer):
+    """
+    collects outgoing mumble messages in one reusable buffer, so that
+    several messages can be written to the socket with a single send()
+    (and thus a single TLS record).
+    """
+
+    def appendFrame(self, mid, payload):
+        """
+        appends a message with type id mid and the serialized payload.
+        """
+        pos = self._reserve(header.size + len(payload))
+        header.pack_into(self._buffer, pos, mid, len(payload))
+        self._buffer[pos + header.size:self._end] = payload
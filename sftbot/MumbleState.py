@@ -0,0 +1,386 @@
+import os
+import sys
+import json
+import zlib
+
+# identifies snapshot files, and their format version.
+SNAPSHOT_MAGIC = "sftbot-mumble-state"
+SNAPSHOT_VERSION = 1
+
+
+class User(object):
+    """
+    a user on the mumble server, identified by the session id.
+    """
+    __slots__ = ('session', 'name', 'userId', 'channelId')
+
+    def __init__(self, session):
+        self.session = session
+        self.name = None
+        # registered user id, or None
+        self.userId = None
+        self.channelId = 0
+
+
+class Channel(object):
+    """
+    a channel on the mumble server.
+    """
+    __slots__ = ('channelId', 'name', 'parent', 'children', 'path')
+
+    def __init__(self, channelId):
+        self.channelId = channelId
+        self.name = None
+        # channel id of the parent channel, or None for the root channel
+        self.parent = None
+        # channel ids of the sub-channels
+        self.children = set()
+        # full path, e.g. 'Root/Games/Lobby', or None while the path to
+        # the root channel is unknown
+        self.path = None
+
+
+class ServerState(object):
+    """
+    the users and channels of a mumble server, as told by UserState,
+    UserRemove, ChannelState and ChannelRemove messages.
+
+    UserState and ChannelState messages only contain the fields that have
+    changed, so they are merged into the existing records.
+
+    at most maxusers users and maxchannels channels are stored; updates
+    for further ones are dropped and counted.
+    """
+
+    def __init__(self, maxusers=100000, maxchannels=10000):
+        self._maxUsers = maxusers
+        self._maxChannels = maxchannels
+        # session id -> User
+        self.users = {}
+        # name -> User
+        self.usersByName = {}
+        # channel id -> Channel
+        self.channels = {}
+        # name -> Channel
+        self.channelsByName = {}
+        # full path -> Channel
+        self.channelsByPath = {}
+        # parent channel id -> set of channel ids, for channels whose
+        # parent is not known (yet)
+        self._orphans = {}
+        # number of dropped updates for new users/channels
+        self.overflows = 0
+
+    def clear(self):
+        self.users.clear()
+        self.usersByName.clear()
+        self.channels.clear()
+        self.channelsByName.clear()
+        self.channelsByPath.clear()
+        self._orphans.clear()
+
+    def updateUser(self, pbMess):
+        """
+        merges a UserState message; returns the User, or None if the
+        user limit was reached.
+        """
+        user = self.users.get(pbMess.session)
+        if user is None:
+            if len(self.users) >= self._maxUsers:
+                self.overflows += 1
+                return None
+            user = User(pbMess.session)
+            self.users[pbMess.session] = user
+
+        if pbMess.HasField('name') and pbMess.name != user.name:
+            if self.usersByName.get(user.name) is user:
+                del self.usersByName[user.name]
+            user.name = pbMess.name
+            self.usersByName[user.name] = user
+        if pbMess.HasField('user_id'):
+            user.userId = pbMess.user_id
+        if pbMess.HasField('channel_id'):
+            user.channelId = pbMess.channel_id
+        return user
+
+    def removeUser(self, session):
+        """
+        removes the user with the given session id, and returns it.
+        """
+        user = self.users.pop(session, None)
+        if user is not None and self.usersByName.get(user.name) is user:
+            del self.usersByName[user.name]
+        return user
+
+    def updateChannel(self, pbMess, updatePaths=True):
+        """
+        merges a ChannelState message; returns the Channel, or None if the
+        channel limit was reached.
+
+        if updatePaths is False, the path index is not updated; call
+        rebuildPaths() afterwards, e.g. after merging a batch of messages.
+        """
+        channel = self.channels.get(pbMess.channel_id)
+        if channel is None:
+            if len(self.channels) >= self._maxChannels:
+                self.overflows += 1
+                return None
+            channel = Channel(pbMess.channel_id)
+            # sub-channels may have arrived before their parent.
+            channel.children = self._orphans.pop(pbMess.channel_id, set())
+            self.channels[pbMess.channel_id] = channel
+
+        moved = False
+        if pbMess.HasField('name') and pbMess.name != channel.name:
+            if self.channelsByName.get(channel.name) is channel:
+                del self.channelsByName[channel.name]
+            channel.name = pbMess.name
+            self.channelsByName[channel.name] = channel
+            moved = True
+        if pbMess.HasField('parent') and pbMess.parent != channel.parent:
+            self._unlink(channel)
+            channel.parent = pbMess.parent
+            self._link(channel)
+            moved = True
+
+        if updatePaths and (moved or channel.path is None):
+            self._updatePaths(channel)
+        return channel
+
+    def rebuildPaths(self):
+        """
+        recomputes the paths of all channels, top-down from the root
+        channels.
+        """
+        self.channelsByPath.clear()
+        for channel in self.channels.itervalues():
+            channel.path = None
+
+        stack = [channel for channel in self.channels.itervalues()
+                 if channel.parent is None and channel.name is not None]
+        for channel in stack:
+            channel.path = channel.name
+        while stack:
+            channel = stack.pop()
+            self.channelsByPath[channel.path] = channel
+            for childId in channel.children:
+                child = self.channels.get(childId)
+                if child is not None and child.name is not None:
+                    child.path = channel.path + '/' + child.name
+                    stack.append(child)
+
+    def removeChannel(self, channelId):
+        """
+        removes the channel with the given id, and returns it.
+        """
+        channel = self.channels.pop(channelId, None)
+        if channel is None:
+            return None
+
+        if self.channelsByName.get(channel.name) is channel:
+            del self.channelsByName[channel.name]
+        self._unlink(channel)
+        # the sub-channels (if any are left) have no valid path anymore.
+        channel.name = None
+        self._updatePaths(channel)
+        if channel.children:
+            self._orphans[channelId] = channel.children
+        return channel
+
+    def _link(self, channel):
+        """
+        adds the channel to its parent's children.
+        """
+        if channel.parent is None:
+            return
+        parent = self.channels.get(channel.parent)
+        if parent is not None:
+            parent.children.add(channel.channelId)
+        else:
+            self._orphans.setdefault(channel.parent, set()).add(
+                channel.channelId)
+
+    def _unlink(self, channel):
+        """
+        removes the channel from its parent's children.
+        """
+        if channel.parent is None:
+            return
+        parent = self.channels.get(channel.parent)
+        if parent is not None:
+            parent.children.discard(channel.channelId)
+        else:
+            orphans = self._orphans.get(channel.parent)
+            if orphans is not None:
+                orphans.discard(channel.channelId)
+                if not orphans:
+                    del self._orphans[channel.parent]
+
+    def _updatePaths(self, channel):
+        """
+        recomputes the paths of channel and its sub-channels, and updates
+        the path index.
+        """
+        stack = [channel]
+        while stack:
+            channel = stack.pop()
+            if channel.name is None:
+                path = None
+            elif channel.parent is None:
+                path = channel.name
+            else:
+                parent = self.channels.get(channel.parent)
+                if parent is None or parent.path is None:
+                    path = None
+                else:
+                    path = parent.path + '/' + channel.name
+
+            if path == channel.path:
+                continue
+
+            if self.channelsByPath.get(channel.path) is channel:
+                del self.channelsByPath[channel.path]
+            channel.path = path
+            if path is not None:
+                self.channelsByPath[path] = channel
+
+            for childId in channel.children:
+                child = self.channels.get(childId)
+                if child is not None:
+                    stack.append(child)
+
+    def findChannel(self, spec):
+        """
+        looks up a channel by its full path ('Root/Games/Lobby'), its path
+        below the root channel ('Games/Lobby'), or its name ('Lobby').
+
+        returns the Channel, or None.
+        """
+        channel = self.channelsByPath.get(spec)
+        if channel is not None:
+            return channel
+
+        root = self.channels.get(0)
+        if root is not None and root.path is not None:
+            channel = self.channelsByPath.get(root.path + '/' + spec)
+            if channel is not None:
+                return channel
+
+        return self.channelsByName.get(spec)
+
+    def getChildren(self, channelId):
+        """
+        returns the sub-channels of the given channel.
+        """
+        channel = self.channels.get(channelId)
+        if channel is None:
+            return []
+        return [self.channels[childId] for childId in channel.children
+                if childId in self.channels]
+
+    def reconcile(self, channelIds, sessions):
+        """
+        removes all channels and users whose ids are not in the given sets,
+        e.g. the stale ones from a snapshot that weren't part of the
+        initial state sent by the server.
+
+        returns the numbers of removed channels and users.
+        """
+        staleChannels = [channelId for channelId in self.channels
+                         if channelId not in channelIds]
+        staleUsers = [session for session in self.users
+                      if session not in sessions]
+        for channelId in staleChannels:
+            self.removeChannel(channelId)
+        for session in staleUsers:
+            self.removeUser(session)
+        return len(staleChannels), len(staleUsers)
+
+    def save(self, filename):
+        """
+        writes a snapshot of all channels and users to filename.
+
+        the file consists of a header line with magic, format version and
+        CRC32 checksum, followed by the zlib-compressed JSON data.
+        """
+        data = {
+            'channels': [(channel.channelId, channel.name, channel.parent)
+                         for channel in self.channels.itervalues()],
+            'users': [(user.session, user.name, user.userId, user.channelId)
+                      for user in self.users.itervalues()],
+        }
+        payload = zlib.compress(json.dumps(data, separators=(',', ':')))
+        header = "%s %d %08x\n" % (SNAPSHOT_MAGIC, SNAPSHOT_VERSION,
+                                   zlib.crc32(payload) & 0xffffffff)
+
+        # write to a temporary file first, so a crash doesn't leave a
+        # truncated snapshot behind.
+        tmpname = filename + ".tmp"
+        with open(tmpname, 'wb') as f:
+            f.write(header)
+            f.write(payload)
+        os.rename(tmpname, filename)
+
+    def load(self, filename):
+        """
+        replaces all channels and users by the ones from the snapshot
+        that was written by save().
+
+        raises an exception if the file is invalid, or was written by an
+        incompatible version.
+        """
+        with open(filename, 'rb') as f:
+            header = f.readline().split()
+            payload = f.read()
+
+        if len(header) != 3 or header[0] != SNAPSHOT_MAGIC:
+            raise Exception("not a state snapshot: " + filename)
+        if int(header[1]) != SNAPSHOT_VERSION:
+            raise Exception("unsupported snapshot version " + header[1])
+        if int(header[2], 16) != zlib.crc32(payload) & 0xffffffff:
+            raise Exception("snapshot checksum mismatch")
+        data = json.loads(zlib.decompress(payload))
+
+        self.clear()
+        for channelId, name, parent in data['channels']:
+            channel = Channel(channelId)
+            channel.name = name
+            channel.parent = parent
+            self.channels[channelId] = channel
+            if name is not None:
+                self.channelsByName[name] = channel
+        for channel in self.channels.itervalues():
+            self._link(channel)
+        self.rebuildPaths()
+
+        for session, name, userId, channelId in data['users']:
+            user = User(session)
+            user.name = name
+            user.userId = userId
+            user.channelId = channelId
+            self.users[session] = user
+            if name is not None:
+                self.usersByName[name] = user
+
+    def stats(self):
+        """
+        returns a dict with the numbers of users and channels, the number
+        of dropped updates, and an estimate of the used memory in bytes.
+        """
+        size = 0
+        for table in (self.users, self.usersByName, self.channels,
+                      self.channelsByName, self.channelsByPath):
+            size += sys.getsizeof(table)
+        for user in self.users.itervalues():
+            size += sys.getsizeof(user) + sys.getsizeof(user.name)
+        for channel in self.channels.itervalues():
+            size += (sys.getsizeof(channel) + sys.getsizeof(channel.name) +
+                     sys.getsizeof(channel.path) +
+                     sys.getsizeof(channel.children))
+
+        return {
+            'users': len(self.users),
+            'channels': len(self.channels),
+            'overflows': self.overflows,
+            'bytes': size,
+        }
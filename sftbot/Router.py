@@ -0,0 +1,98 @@
+class Router(object):
+    """
+    relays the text messages of connections to other connections.
+
+    each route connects a source connection to one or more destination
+    connections, with a template for the relayed messages. the routes are
+    compiled into a table: source name -> list of (formatter, destination
+    connections), where routes with the same template share one entry, so
+    every message is formatted once per template, and dispatched to all
+    destinations in one pass.
+
+    templates are str.format() strings; the fields {source} (the source
+    connection name), {sender} and {message} are available.
+    """
+
+    def __init__(self):
+        # name -> connection
+        self._connections = {}
+        # (source name, destination names, template), as they were added
+        self._routes = []
+        self._table = {}
+
+    def addConnection(self, name, connection):
+        """
+        makes the connection available as source and destination of
+        routes under the given name.
+        """
+        if name in self._connections:
+            raise Exception("duplicate connection name: " + name)
+        self._connections[name] = connection
+        connection.registerTextCallback(
+            lambda sender, message: self.dispatch(name, sender, message))
+
+    def addRoute(self, source, destinations, template):
+        """
+        relays all text messages of the source connection to each of the
+        destination connections, formatted with template.
+        """
+        for name in [source] + list(destinations):
+            if name not in self._connections:
+                raise Exception("route uses unknown connection: " + name)
+        if isinstance(template, str):
+            template = template.decode('utf-8')
+        # validate the template now, instead of failing for every message.
+        try:
+            template.format(source=u'', sender=u'', message=u'')
+        except (KeyError, IndexError, ValueError) as e:
+            raise Exception("invalid route format %r: %s" % (template, e))
+
+        self._routes.append((source, tuple(destinations), template))
+        self._compile()
+
+    def _compile(self):
+        table = {}
+        for source, destinations, template in self._routes:
+            entries = table.setdefault(source, [])
+            for entry in entries:
+                if entry[0] == template:
+                    break
+            else:
+                entry = (template, template.format, [])
+                entries.append(entry)
+            for name in destinations:
+                connection = self._connections[name]
+                if connection not in entry[2]:
+                    entry[2].append(connection)
+
+        self._table = dict(
+            (source, [(formatter, tuple(connections))
+                      for _, formatter, connections in entries])
+            for source, entries in table.items())
+
+    def dispatch(self, source, sender, message):
+        """
+        relays a text message of the source connection to all of its
+        routes' destinations.
+        """
+        for formatter, destinations in self._table.get(source, ()):
+            text = formatter(source=source, sender=sender, message=message)
+            for destination in destinations:
+                destination.sendTextMessage(text)
+
+    def destinations(self, source):
+        """
+        returns the names of the destinations of the source's routes.
+        """
+        names = []
+        for routeSource, destinations, _ in self._routes:
+            if routeSource == source:
+                names.extend(name for name in destinations
+                             if name not in names)
+        return names
+
+    def routes(self):
+        """
+        returns the list of (source, destinations, template) tuples.
+        """
+        return list(self._routes)
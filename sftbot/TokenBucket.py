@@ -0,0 +1,45 @@
+import time
+
+
+class TokenBucket(object):
+    """
+    token bucket rate limiter: allows bursts of up to 'burst' operations,
+    and 'rate' operations per second on average.
+    """
+
+    def __init__(self, rate, burst):
+        self._rate = float(rate)
+        self._burst = float(burst)
+        self._tokens = self._burst
+        self._updated = time.time()
+
+    def _refill(self, now):
+        if now > self._updated:
+            self._tokens = min(self._burst, self._tokens +
+                               (now - self._updated) * self._rate)
+        self._updated = now
+
+    def take(self, now=None):
+        """
+        tries to take one token.
+
+        returns 0 on success, or the number of seconds until the next token
+        will be available.
+        """
+        if now is None:
+            now = time.time()
+        self._refill(now)
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0
+        return (1 - self._tokens) / self._rate
+
+    def force(self, now=None):
+        """
+        takes one token, even if none is available; the bucket then owes
+        tokens, which delays the following take() calls accordingly.
+        """
+        if now is None:
+            now = time.time()
+        self._refill(now)
+        self._tokens -= 1
@@ -0,0 +1,77 @@
+import util
+
+
+class WriteBuffer(object):
+    """
+    collects outgoing data in one reusable buffer, and writes it to a
+    non-blocking socket through memoryviews, so that partial writes
+    don't copy the remaining data.
+    """
+
+    def __init__(self, size=65536):
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+        # start of the first unsent byte
+        self._start = 0
+        # end of the buffered data
+        self._end = 0
+
+    def __len__(self):
+        """
+        number of buffered, but unsent bytes.
+        """
+        return self._end - self._start
+
+    def append(self, data):
+        """
+        appends data to the buffer.
+        """
+        pos = self._reserve(len(data))
+        self._buffer[pos:pos + len(data)] = data
+
+    def writeTo(self, sock):
+        """
+        sends as much of the buffered data via sock.send() as the socket
+        accepts without blocking.
+
+        returns True if everything has been sent.
+        """
+        while self._start < self._end:
+            try:
+                sent = sock.send(self._view[self._start:self._end])
+            except Exception as e:
+                if util.would_block(e):
+                    return False
+                raise
+            if sent <= 0:
+                return False
+            self._start += sent
+
+        self._start = self._end = 0
+        return True
+
+    def _reserve(self, size):
+        """
+        ensures that size bytes can be appended to the buffer, and marks
+        them as used.
+
+        returns the position of the reserved bytes.
+        """
+        if self._end + size > len(self._buffer):
+            pending = self._end - self._start
+            if pending + size > len(self._buffer):
+                newsize = len(self._buffer)
+                while newsize < pending + size:
+                    newsize *= 2
+                buf = bytearray(newsize)
+                buf[:pending] = self._buffer[self._start:self._end]
+                self._buffer = buf
+                self._view = memoryview(buf)
+            else:
+                self._buffer[:pending] = self._buffer[self._start:self._end]
+            self._start = 0
+            self._end = pending
+
+        pos = self._end
+        self._end += size
+        return pos
@@ -3,86 +3,204 @@ import sys
 import MumbleConnection
 import IRCConnection
 import ConsoleConnection
-import time
+import EventLoop
+import LogWriter
+import Metrics
+import MetricsServer
+import Router
+import util
 import ConfigParser
 import os.path
 import sftbot
 
-irc = None
-mumble = None
+# connection name -> connection, for all connections
+connections = {}
 console = None
+router = None
+loop = None
+
+
+def serverConnections():
+    """
+    returns the (name, connection) tuples of the mumble and IRC
+    connections, sorted by name.
+    """
+    return [(name, connection)
+            for name, connection in sorted(connections.items())
+            if connection is not console]
+
+
+def latencyReport():
+    return "\n".join(name + ": " + connection.latencySummary()
+                     for name, connection in serverConnections())
+
+
+# the text messages are relayed by the router; this callback only
+# handles commands.
+def textMessageCallback(name, sender, message):
+    connection = connections[name]
+    if(message == 'latency'):
+        connection.sendTextMessage(latencyReport())
+    if(message == 'gtfo' and connection is not console):
+        connection.sendTextMessage("KAY CU")
+        # leave for a while; mumble connections come back faster.
+        if isinstance(connection, MumbleConnection.MumbleConnection):
+            connection.restart(5)
+        else:
+            connection.restart(15)
 
 
-def mumbleTextMessageCallback(sender, message):
-    line = "mumble: " + sender + ": " + message
-    console.sendTextMessage(line)
-    irc.sendTextMessage(line)
-    if(message == 'gtfo'):
-        mumble.sendTextMessage("KAY CU")
-        mumble.stop()
-
-
-def ircTextMessageCallback(sender, message):
-    line = "irc: " + sender + ": " + message
-    console.sendTextMessage(line)
-    mumble.sendTextMessage(line)
-    if (message == 'gtfo'):
-        irc.sendTextMessage("KAY CU")
-        irc.stop()
-
-
-def consoleTextMessageCallback(sender, message):
-    line = "console: " + message
-    irc.sendTextMessage(line)
-    mumble.sendTextMessage(line)
-
-
-def mumbleConnected():
-    irc.setAway()
-
-
-def mumbleDisconnected():
-    line = "connection to mumble lost. reconnect in 5 seconds."
-    console.sendTextMessage(line)
-    irc.setAway(line)
-    time.sleep(5)
-    mumble.start()
-
-
-def mumbleConnectionFailed():
-    line = "connection to mumble failed. retrying in 15 seconds."
-    console.sendTextMessage(line)
-    irc.setAway(line)
-    time.sleep(15)
-    mumble.start()
+def reportStatus(name, line):
+    """
+    tells the console and the destinations of the connection's routes
+    about a connection problem, or that it's solved (if line is None).
+    """
+    if line is not None:
+        console.sendTextMessage(line)
+    for destination in router.destinations(name):
+        connection = connections[destination]
+        if isinstance(connection, IRCConnection.IRCConnection):
+            connection.setAway(line)
+        elif isinstance(connection, MumbleConnection.MumbleConnection):
+            connection.setComment(line or "")
 
 
-def ircConnected():
-    mumble.setComment()
+def connected(name):
+    reportStatus(name, None)
 
 
-def ircDisconnected():
-    line = "connection to irc lost. reconnect in 15 seconds."
-    console.sendTextMessage(line)
-    mumble.setComment(line)
-    time.sleep(15)
-    irc.start()
+# the connections reconnect by themselves; these callbacks only report.
+def disconnected(name):
+    delay = connections[name].reconnectDelay()
+    if delay is None:
+        reportStatus(name, "connection to %s closed." % name)
+    else:
+        reportStatus(name, "connection to %s lost. reconnect in %d seconds." %
+                     (name, delay))
 
 
-def ircConnectionFailed():
-    line = "connection to irc failed. retrying in 15 seconds."
-    console.sendTextMessage(line)
-    mumble.setComment(line)
-    time.sleep(15)
-    irc.start()
+def connectionFailed(name):
+    delay = connections[name].reconnectDelay()
+    if delay is None:
+        reportStatus(name, "connection to %s failed." % name)
+    else:
+        reportStatus(name, "connection to %s failed. retrying in %d "
+                     "seconds." % (name, delay))
+
+
+def getOptional(cparser, section, option, default):
+    """
+    returns the config value, or default if it isn't set.
+    """
+    if cparser.has_option(section, option):
+        return cparser.get(section, option)
+    return default
+
+
+def readRoutes(cparser, router):
+    """
+    adds the routes from the [route:...] sections to the router, e.g.
+
+        [route:mumble-to-irc]
+        from=mumble
+        to=irc console
+        format=<{sender}> {message}
+
+    without any, messages from each connection are relayed to all others.
+    """
+    sections = [section for section in cparser.sections()
+                if section.startswith('route:')]
+    if not sections:
+        for name in sorted(connections):
+            if connections[name] is console:
+                template = "{source}: {message}"
+            else:
+                template = "{source}: {sender}: {message}"
+            router.addRoute(name, [other for other in sorted(connections)
+                                   if other != name], template)
+        return
+
+    for section in sections:
+        router.addRoute(cparser.get(section, 'from'),
+                        cparser.get(section, 'to').split(),
+                        getOptional(cparser, section, 'format',
+                                    "{source}: {sender}: {message}"))
+
+
+def reconnectOptions(cparser, section, delay):
+    """
+    returns the reconnect keyword arguments for the connection; delay is
+    the default initial reconnect delay.
+    """
+    return {
+        'reconnect': True,
+        'reconnectdelay': float(getOptional(cparser, section,
+                                            'reconnectdelay', delay)),
+        'reconnectmaxdelay': float(getOptional(cparser, section,
+                                               'reconnectmaxdelay', 300)),
+        'reconnectjitter': float(getOptional(cparser, section,
+                                             'reconnectjitter', 0.25)),
+        'reconnectstable': float(getOptional(cparser, section,
+                                             'reconnectstable', 60)),
+    }
+
+
+def isConnectionSection(section, kind):
+    """
+    returns True for the sections [kind] and [kind:name].
+    """
+    return section == kind or section.startswith(kind + ':')
+
+
+def createMumbleConnection(cparser, section, sslcontext):
+    return MumbleConnection.MumbleConnection(
+        cparser.get(section, 'server'),
+        int(cparser.get(section, 'port')),
+        cparser.get(section, 'nickname'),
+        cparser.get(section, 'channel'),
+        cparser.get(section, 'password'),
+        section,
+        int(cparser.get(section, 'loglevel')),
+        deaf=(cparser.has_option(section, 'deaf') and
+              cparser.getboolean(section, 'deaf')),
+        statefile=getOptional(cparser, section, 'statefile', None),
+        maxusers=int(getOptional(cparser, section, 'maxusers', 100000)),
+        maxchannels=int(getOptional(cparser, section, 'maxchannels', 10000)),
+        sslcontext=sslcontext,
+        sendqueuelimit=int(getOptional(cparser, section, 'sendqueue', 1000)),
+        holdlimit=int(getOptional(cparser, section, 'holdlimit', 100)),
+        holdtime=float(getOptional(cparser, section, 'holdtime', 600)),
+        # mumble connections are retried faster.
+        **reconnectOptions(cparser, section, 5))
+
+
+def createIRCConnection(cparser, section):
+    return IRCConnection.IRCConnection(
+        cparser.get(section, 'server'),
+        int(cparser.get(section, 'port')),
+        cparser.get(section, 'nickname'),
+        cparser.get(section, 'channel'),
+        getOptional(cparser, section, 'password', ''),
+        cparser.get(section, 'authtype'),
+        cparser.get(section, 'encoding'),
+        section,
+        int(cparser.get(section, 'loglevel')),
+        maxlinelength=int(getOptional(cparser, section, 'maxlinelength',
+                                      8192)),
+        sendqueuelimit=int(getOptional(cparser, section, 'sendqueue', 1000)),
+        sendrate=float(getOptional(cparser, section, 'floodrate', 1)),
+        sendburst=int(getOptional(cparser, section, 'floodburst', 5)),
+        holdlimit=int(getOptional(cparser, section, 'holdlimit', 100)),
+        holdtime=float(getOptional(cparser, section, 'holdtime', 600)),
+        **reconnectOptions(cparser, section, 15))
 
 
 def main():
     print("sft mumble bot " + sftbot.VERSION)
 
-    global mumble
-    global irc
     global console
+    global router
+    global loop
 
     loglevel = 3
 
@@ -109,75 +227,74 @@ def main():
     cparser = ConfigParser.ConfigParser()
     cparser.read(conffile)
 
-    # configuration for the mumble connection
-    mblservername = cparser.get('mumble', 'server')
-    mblport = int(cparser.get('mumble', 'port'))
-    mblnick = cparser.get('mumble', 'nickname')
-    mblchannel = cparser.get('mumble', 'channel')
-    mblpassword = cparser.get('mumble', 'password')
-    mblloglevel = int(cparser.get('mumble', 'loglevel'))
-
-    # configuration for the IRC connection
-    ircservername = cparser.get('irc', 'server')
-    ircport = int(cparser.get('irc', 'port'))
-    ircnick = cparser.get('irc', 'nickname')
-    ircchannel = cparser.get('irc', 'channel')
-    ircpassword = cparser.get('irc', 'password', '')
-    ircauthtype = cparser.get('irc', 'authtype')
-    ircencoding = cparser.get('irc', 'encoding')
-    ircloglevel = int(cparser.get('irc', 'loglevel'))
-
-    # create server connections
-    # hostname, port, nickname, channel, password, name, loglevel
-    mumble = MumbleConnection.MumbleConnection(
-        mblservername,
-        mblport,
-        mblnick,
-        mblchannel,
-        mblpassword,
-        "mumble",
-        mblloglevel)
-
-    irc = IRCConnection.IRCConnection(
-        ircservername,
-        ircport,
-        ircnick,
-        ircchannel,
-        ircpassword,
-        ircauthtype,
-        ircencoding,
-        "irc",
-        ircloglevel)
+    # all connections are driven by this event loop, and log through the
+    # same writer; the mumble connections share one SSL context.
+    loop = EventLoop.defaultLoop()
+    sslcontext = util.client_ssl_context()
+
+    # create a server connection for each [mumble...] and [irc...] section;
+    # the section name is the connection name.
+    for section in cparser.sections():
+        if isConnectionSection(section, 'mumble'):
+            connections[section] = createMumbleConnection(cparser, section,
+                                                          sslcontext)
+        elif isConnectionSection(section, 'irc'):
+            connections[section] = createIRCConnection(cparser, section)
 
     console = ConsoleConnection.ConsoleConnection(
         "utf-8",
         "console",
         loglevel)
-
-    # register text callback functions
-    mumble.registerTextCallback(mumbleTextMessageCallback)
-    irc.registerTextCallback(ircTextMessageCallback)
-    console.registerTextCallback(consoleTextMessageCallback)
-
-    # register connection-established callback functions
-    mumble.registerConnectionEstablishedCallback(mumbleConnected)
-    irc.registerConnectionEstablishedCallback(ircConnected)
-
-    # register connection-lost callback functions
-    irc.registerConnectionLostCallback(ircDisconnected)
-    mumble.registerConnectionLostCallback(mumbleDisconnected)
-
-    # register connection-failed callback functions
-    irc.registerConnectionFailedCallback(ircConnectionFailed)
-    mumble.registerConnectionFailedCallback(mumbleConnectionFailed)
+    connections['console'] = console
+
+    # relay the text messages along the configured routes
+    router = Router.Router()
+    for name, connection in sorted(connections.items()):
+        router.addConnection(name, connection)
+    readRoutes(cparser, router)
+
+    for name, connection in connections.items():
+        # bind the current name to each callback.
+        connection.registerTextCallback(
+            lambda sender, message, name=name:
+                textMessageCallback(name, sender, message))
+        if connection is console:
+            continue
+        connection.registerConnectionEstablishedCallback(
+            lambda name=name: connected(name))
+        connection.registerConnectionLostCallback(
+            lambda name=name: disconnected(name))
+        connection.registerConnectionFailedCallback(
+            lambda name=name: connectionFailed(name))
+
+    # the bot terminates once the console is closed.
+    console.registerConnectionLostCallback(loop.stop)
+    console.registerConnectionFailedCallback(loop.stop)
+
+    # serve the metrics of all connections, if configured.
+    if cparser.has_section('metrics'):
+        metricsserver = MetricsServer.MetricsServer(
+            Metrics.defaultMetrics(),
+            getOptional(cparser, 'metrics', 'address', '127.0.0.1'),
+            int(getOptional(cparser, 'metrics', 'port', 9300)))
+        metricsserver.start()
 
     # start the connections.
     # they will be self-sustaining due to the callback functions.
-    mumble.start()
-    irc.start()
-
-    # start the console connection, outside a thread (as main loop)
-    console.run()
+    for name, connection in sorted(connections.items()):
+        connection.start()
+
+    # run the event loop in the main thread
+    try:
+        loop.run()
+    except KeyboardInterrupt:
+        print("keyboard interrupt")
+
+    for name, connection in serverConnections():
+        if isinstance(connection, MumbleConnection.MumbleConnection):
+            connection.saveState()
+    # write the remaining log messages.
+    LogWriter.defaultWriter().close()
 
 
 if __name__ == "__main__":
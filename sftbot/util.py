@@ -1,3 +1,10 @@
+import os
+import ssl
+import errno
+import codecs
+import socket
+
+
 def try_decode(line, preferredcodec):
     try:
         return line.decode(preferredcodec)
@@ -49,3 +56,134 @@ def try_encode(line, preferredcodec):
         pass
 
     return "[encoding error]"
+
+
+def split_encoded(text, encoding, maxbytes):
+    """
+    splits text into pieces whose encoded form is at most maxbytes long.
+
+    pieces are split at spaces where possible (the space is dropped), and
+    never inside of a multi-byte character.
+    returns the list of (decoded) pieces.
+    """
+    data = try_encode(text, encoding)
+    if len(data) <= maxbytes:
+        return [text]
+
+    if codecs.lookup(encoding).name == 'utf-8':
+        # continuation bytes are never the start of a character.
+        def boundary(pos):
+            while pos > 0 and (ord(data[pos:pos + 1]) & 0xc0) == 0x80:
+                pos -= 1
+            return pos
+    else:
+        # other encodings: determine the character offsets while encoding.
+        encoder = codecs.getincrementalencoder(encoding)('ignore')
+        chars = [encoder.encode(char) for char in text]
+        data = b''.join(chars)
+        starts = bytearray(len(data) + 1)
+        pos = 0
+        for char in chars:
+            starts[pos] = 1
+            pos += len(char)
+
+        def boundary(pos):
+            while pos > 0 and not starts[pos]:
+                pos -= 1
+            return pos
+
+    pieces = []
+    start = 0
+    while len(data) - start > maxbytes:
+        end = start + maxbytes
+        space = data.rfind(b' ', start + 1, end + 1)
+        if space > start:
+            pieces.append(data[start:space])
+            start = space + 1
+        else:
+            end = boundary(end)
+            if end <= start:
+                # maxbytes is smaller than a single character.
+                end = start + maxbytes
+            pieces.append(data[start:end])
+            start = end
+    pieces.append(data[start:])
+
+    return [piece.decode(encoding, 'ignore') for piece in pieces]
+
+
+def client_ssl_context():
+    """
+    returns an SSLContext for client connections that, like
+    ssl.wrap_socket(), doesn't verify the server certificate; or None if
+    this python version has no SSLContext.
+
+    one context can be shared by any number of connections.
+    """
+    if not hasattr(ssl, 'SSLContext'):
+        return None
+    context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+    context.options |= ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+def start_connect(hostname, port):
+    """
+    returns a non-blocking TCP socket that is connecting to hostname:port.
+    the connection is complete once the socket is writable; then,
+    finish_connect() raises an exception if it has failed.
+
+    only the hostname lookup may block.
+    """
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        s.setblocking(False)
+        err = s.connect_ex((hostname, port))
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            raise socket.error(err, os.strerror(err))
+    except:
+        s.close()
+        raise
+    return s
+
+
+def finish_connect(s):
+    """
+    raises an exception if the connection attempt of the socket that was
+    returned by start_connect() has failed.
+    """
+    err = s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+    if err:
+        raise socket.error(err, os.strerror(err))
+
+
+def ssl_handshake(s):
+    """
+    continues the handshake of a non-blocking SSL socket.
+
+    returns True once it is complete, or 'read' or 'write' if it has to
+    wait for the socket to become readable or writable.
+    """
+    try:
+        s.do_handshake()
+    except ssl.SSLError as e:
+        if e.args[0] == ssl.SSL_ERROR_WANT_READ:
+            return 'read'
+        if e.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+            return 'write'
+        raise
+    return True
+
+
+def would_block(exception):
+    """
+    returns True if the exception was raised by an operation on a
+    non-blocking (SSL) socket that can't proceed right now.
+    """
+    if isinstance(exception, ssl.SSLError):
+        return exception.args[0] in (ssl.SSL_ERROR_WANT_READ,
+                                     ssl.SSL_ERROR_WANT_WRITE)
+    if isinstance(exception, socket.error):
+        return exception.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK)
+    return False